@@ -0,0 +1,147 @@
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for folder in ('reasoners', 'context_management', 'completions', 'code_gen'):
+    sys.path.append(os.path.join(root, folder))
+
+from code_gen import generate_function
+from context_management import Context, EvictionPolicy
+from internal_monologue import Reasoner
+from local import LocalBackend
+from memory import MemoryManager
+from objective_oriented import ObjectiveReasoner
+import structured
+import structured2
+
+
+SYSTEM_PROMPT = "You use your internal monologue to reason before responding to the user."
+USER_MESSAGE = "Tell me something interesting about the history of mathematics, and keep it short."
+
+# Every session takes a backend, a number of turns and an eviction policy, and returns what it built so the
+# memory it holds on to can be measured
+
+
+def reasoner_session(backend, turns, eviction):
+    reasoner = Reasoner(SYSTEM_PROMPT, eviction=eviction, backend=backend)
+    for _ in range(turns):
+        reasoner.add_message('user', USER_MESSAGE)
+        reasoner.internal_monologue("I should think about how to respond.")
+        reasoner.external_dialogue("I'll respond to the user.")
+    return reasoner
+
+
+def structured_session(backend, turns, eviction):
+    reasoner = structured.StructuredReasoner(SYSTEM_PROMPT, eviction=eviction, backend=backend)
+    for _ in range(turns):
+        reasoner.add_message('user', USER_MESSAGE)
+        reasoner.internal_monologue("I should brainstorm some ways to respond.")
+        options = reasoner.parse_response_options()
+        reasoner.choose(options)
+        reasoner.external_dialogue("I'll respond to the user using the response I chose.")
+    return reasoner
+
+
+def extraction_session(backend, turns, eviction):
+    reasoner = structured2.StructuredReasoner(SYSTEM_PROMPT, eviction=eviction, backend=backend)
+    for _ in range(turns):
+        reasoner.add_message('user', USER_MESSAGE)
+        reasoner.extract_infos([("The topic is {topic}.", str), ("I'd rate it {rating} out of 10.", int)])
+        reasoner.external_dialogue("I'll respond to the user.")
+    return reasoner
+
+
+def objective_session(backend, turns, eviction):
+    reasoner = ObjectiveReasoner("Teach the user something new.", SYSTEM_PROMPT, eviction=eviction, backend=backend)
+    for _ in range(turns):
+        reasoner.add_message('user', USER_MESSAGE)
+        reasoner.internal_monologue("I should reflect on my objective.")
+        reasoner.evaluate_objective()
+        reasoner.external_dialogue("I'll respond to the user.")
+    return reasoner
+
+
+def memory_session(backend, turns, eviction):
+    context = Context([{'role': 'system', 'content': SYSTEM_PROMPT}], eviction=eviction)
+    memory = MemoryManager(context)
+    memory.add_memory('user_name', 'The user is called Ada.')
+    memory.add_memory('date', lambda: time.strftime('Today is %Y-%m-%d.'), ttl=60)
+    memory.add_memory('turn', lambda: f'This is turn {len(context.messages)}.')
+    for _ in range(turns):
+        context.add_message('user', USER_MESSAGE)
+        memory.load_memories()
+        context.fit()
+        context.add_message('assistant', backend.complete(context.messages.to_dicts(), model='gpt-4'))
+    return memory
+
+
+def codegen_session(backend, turns, eviction):
+    return [generate_function(f"Returns x plus {i}.", 'add', backend=backend) for i in range(turns)]
+
+
+def codegen_responses(messages, **kwargs):
+    n = messages[-1]['content'].split('plus ')[-1].rstrip('.')
+    return f"I'll add the number.\n```python\ndef add(x):\n    return x + {n}\n```"
+
+
+SESSIONS = {
+    'reasoner': (reasoner_session, None),
+    'structured': (structured_session, None),
+    'extraction': (extraction_session, None),
+    'objective': (objective_session, None),
+    'memory': (memory_session, None),
+    'generate_function': (codegen_session, codegen_responses),
+}
+
+
+def run(name, turns, eviction, memory=True):
+    session, responses = SESSIONS[name]
+
+    backend = LocalBackend(responses, record=False)
+    gc.collect()
+    start = time.process_time()
+    session(backend, turns, eviction)
+    cpu_time = time.process_time() - start - backend.cpu_time
+    result = {
+        'calls/turn': backend.usage['calls'] / turns,
+        'prompt tokens/turn': backend.usage['prompt_tokens'] / turns,
+        'cpu µs/turn': cpu_time / turns * 1e6,
+    }
+
+    if memory:
+        # A second run, since tracing allocations slows everything down
+        backend = LocalBackend(responses, record=False)
+        gc.collect()
+        tracemalloc.start()
+        state = session(backend, turns, eviction)
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del state
+        result['retained KiB'] = retained / 1024
+        result['peak KiB'] = peak / 1024
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measures the framework's overhead on a local backend, without any API calls.")
+    parser.add_argument('sessions', nargs='*', help=f"sessions to run, out of {', '.join(SESSIONS)} (all of them by default)")
+    parser.add_argument('--turns', type=int, default=10000)
+    parser.add_argument('--max-tokens', type=int, default=4000, help='context size for the eviction policy, 0 to keep every message')
+    parser.add_argument('--no-memory', action='store_true', help="skip measuring memory, which needs a second run")
+    args = parser.parse_args()
+    for name in args.sessions:
+        if name not in SESSIONS:
+            parser.error(f'unknown session: {name}')
+
+    eviction = EvictionPolicy(args.max_tokens, max_monologue_tokens=args.max_tokens // 4) if args.max_tokens else None
+    columns = None
+    for name in args.sessions or SESSIONS:
+        result = run(name, args.turns, eviction, memory=not args.no_memory)
+        if columns is None:
+            columns = list(result)
+            print(f"{'session':<20}" + ''.join(f'{column:>20}' for column in columns))
+        print(f'{name:<20}' + ''.join(f'{result[column]:>20.1f}' for column in columns))
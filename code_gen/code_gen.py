@@ -1,52 +1,346 @@
+import ast
+import multiprocessing
 import re
+import time
+import timeit
 import traceback
+from contextlib import nullcontext
 
 import chatgpt
+from function_cache import FunctionCache
 
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
 
 
 def extract_markdown_code_blocks(s):
     return re.findall(r'```(?:python)?\n(.*?)\n```', s, re.DOTALL)
 
 
-def generate_function(function_description, func_name, max_retries=3, debug=False):
-    messages =[
-        {'role': 'system', 'content': "Start by stating your assumptions and explaining your approach. Only write the `rev` function, no other code allowed. Include a single code block. Do not call `rev`."},
-        {'role': 'user', 'content': f"Write a python function called `{func_name}`. Here's the description of the function:\n\n" + function_description}
-    ]
-    
-    retries = 0
-    while retries < max_retries:
-        response = chatgpt.complete(messages=messages, model='gpt-4', use_cache=True)
-        messages.append({'role': 'assistant', 'content': response})
-
-        code = extract_markdown_code_blocks(response)
-        if not code:
-            messages.append({'role': 'user', 'content': "I couldn't find any executable code in your response, can you make sure to include a code block?"})
-            retries += 1
+def check_function(func, tests, repeat=5, time_budget=None, max_seconds=0.2):
+    """
+    Runs the function on a list of (args, expected) test cases, and raises an AssertionError if any result is wrong.
+    Then times it with time_function() and returns the time for running all the test cases once, in seconds, or None
+    with repeat=0. The function is called many times, so it shouldn't modify its arguments.
+    """
+    for args, expected in tests:
+        result = func(*args)
+        if result != expected:
+            raise AssertionError(f"{func.__name__}({', '.join(map(repr, args))}) returned {result!r}, expected {expected!r}")
+    return time_function(func, tests, repeat, time_budget, max_seconds) if repeat else None
+
+
+def time_function(func, tests, repeat=5, time_budget=None, max_seconds=0.2):
+    """
+    Returns the best time for running all the test cases once, in seconds, out of up to `repeat` rounds that take
+    about `max_seconds` in total. Stops as soon as the best time is over `time_budget`, since the function won't fit it.
+    """
+    timer = timeit.Timer(lambda: [func(*args) for args, _ in tests])
+    best = timer.timeit(1)
+    deadline = time.perf_counter() + max_seconds
+    # Each round calls the function about as many times as fit in its share of max_seconds
+    number = max(1, min(int(max_seconds / repeat / best), 10000)) if best > 0 else 10000
+    for _ in range(repeat):
+        if time_budget is not None and best > time_budget or time.perf_counter() >= deadline:
+            break
+        best = min(best, timer.timeit(number) / number)
+    return best
+
+
+def format_seconds(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('µs', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.3g}{unit}'
+    return f'{seconds / 1e-9:.3g}ns'
+
+
+FORBIDDEN_IMPORTS = frozenset({'ctypes', 'multiprocessing', 'shutil', 'socket', 'subprocess'})
+
+def static_check(code, func_name, forbidden_imports=FORBIDDEN_IMPORTS):
+    """Checks the code without running it. Returns what's wrong with it, or None if it looks fine."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return f"SyntaxError: {e.msg} (line {e.lineno})"
+
+    defined = set()
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            defined.add(node.name)
+        elif isinstance(node, ast.Assign):
+            defined.update(target.id for target in node.targets if isinstance(target, ast.Name))
+    if func_name not in defined:
+        return f"The code doesn't define a function called `{func_name}`."
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            modules = [node.module]
+        else:
             continue
-        code = '\n\n'.join(code)
-        if debug:
-            print('#'*120)
-            print(code)
-            print('#'*120)
+        for module in modules:
+            if module.split('.')[0] in forbidden_imports:
+                return f"Importing `{module}` isn't allowed (line {node.lineno})."
+
+
+def summarize_error(error_message, max_lines=6):
+    """Shortens a traceback to the lines in the generated code and the exception itself."""
+    lines = error_message.strip().splitlines()
+    summary = [line.strip().replace('File "<string>", ', '') for line in lines[:-1] if line.strip().startswith('File "<string>"')]
+    return '\n'.join(summary[-(max_lines - 1):] + lines[-1:])
+
 
+_NO_SPAN = nullcontext()
+
+def _span(tracer, name, **attrs):
+    return _NO_SPAN if tracer is None else tracer.span(name, **attrs)
+
+
+class SandboxError(Exception):
+    pass
+
+
+# These run inside the sandbox worker processes
+_namespaces = {}
+
+def _init_worker(memory_limit):
+    if resource is not None and memory_limit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+def _load(code, func_name):
+    if code not in _namespaces:
         namespace = {}
+        exec(code, namespace)
+        if not callable(namespace.get(func_name)):
+            raise NameError(f"The code doesn't define a function called `{func_name}`.")
+        _namespaces[code] = namespace
+    return _namespaces[code][func_name]
+
+def _check(code, func_name, tests):
+    func = _load(code, func_name)
+    if tests:
+        check_function(func, tests, repeat=0)
+
+def _time(code, func_name, tests, repeat, time_budget, max_seconds):
+    return time_function(_load(code, func_name), tests, repeat, time_budget, max_seconds)
+
+def _run(func, *args):
+    try:
+        return True, func(*args)
+    except BaseException as e:
+        return False, f"{e!r}\n\n{traceback.format_exc()}"
+
+def _call(code, func_name, args, kwargs):
+    return _load(code, func_name)(*args, **kwargs)
+
+
+class Sandbox:
+    """
+    A pool of worker processes for running generated code with a wall clock timeout and a memory limit (in bytes).
+    The workers are started once and reused for every attempt and every call. If a call times out, the pool is
+    restarted, since there's no way to interrupt the stuck worker.
+    """
+    def __init__(self, processes=2, timeout=10, memory_limit=2**30):
+        self.processes = processes
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self._start()
+
+    def _start(self):
+        # spawn instead of fork, so the workers don't inherit locks held by other threads
+        context = multiprocessing.get_context('spawn')
+        self._pool = context.Pool(self.processes, initializer=_init_worker, initargs=(self.memory_limit,))
+
+    def run(self, func, *args, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        result = self._pool.apply_async(_run, (func, *args))
         try:
-            exec(code, namespace)
-        except Exception as e:
-            error_message = traceback.format_exc()
-            messages.append({'role': 'user', 'content': f"Error: {e}\n\nI got an error running your code. Here is the full error message:\n{error_message}\nCan you rewrite the entire code you wrote and try again?"})
+            ok, value = result.get(timeout)
+        except multiprocessing.TimeoutError:
+            self._pool.terminate()
+            self._start()
+            raise SandboxError(f"Timed out after {timeout} seconds.")
+        if not ok:
+            raise SandboxError(value)
+        return value
+
+    def check(self, code, func_name, tests=None, repeat=5, time_budget=None, max_seconds=0.2):
+        """
+        Runs the code in a worker, and checks that it defines `func_name`. See check_function for the tests.
+        Timing it is a separate call, which gets `max_seconds` on top of the timeout, so it isn't cut short by it.
+        """
+        self.run(_check, code, func_name, tests)
+        if not tests or not repeat:
+            return None
+        return self.run(_time, code, func_name, tests, repeat, time_budget, max_seconds, timeout=self.timeout + 2 * max_seconds)
+
+    def call(self, code, func_name, args=(), kwargs=None):
+        return self.run(_call, code, func_name, args, kwargs or {})
+
+    def close(self):
+        self._pool.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SandboxedFunction:
+    """A generated function that runs in the sandbox. Arguments and return values must be picklable."""
+    def __init__(self, sandbox, code, func_name):
+        self.sandbox = sandbox
+        self.code = code
+        self.__name__ = func_name
+
+    def __call__(self, *args, **kwargs):
+        return self.sandbox.call(self.code, self.__name__, args, kwargs)
+
+
+def generate_function(function_description, func_name, max_retries=3, debug=False, sandbox=None, proxy=False, model='gpt-4', cache=None,
+                      tests=None, time_budget=None, repeat=5, candidates=1, repair=False, forbidden_imports=FORBIDDEN_IMPORTS, backend=chatgpt,
+                      tracer=None):
+    """
+    Generates a python function from a description, retrying with the error message if the code fails to run.
+
+    If a Sandbox is given, the generated code is run in the sandbox's worker processes instead of this one, so code
+    that hangs or uses too much memory is treated as an error. Once the code runs fine, it's loaded in this process,
+    or with proxy=True, a SandboxedFunction that calls it in the sandbox is returned instead.
+
+    If a FunctionCache is given, a function that was already generated for the same description, name and model, and
+    accepted with the same tests and time budget, is loaded from it without calling the model, and new functions are
+    added to it.
+
+    `tests` is a list of (args, expected) pairs that the function has to pass, e.g. [((2, 3), 5), ((0, 0), 0)].
+    With a `time_budget` or `candidates` > 1, functions that pass are timed over the tests (see time_function), and if
+    they take longer than `time_budget` seconds, the model is asked to make them faster. With `candidates` > 1, several
+    functions are sampled per attempt and the fastest one that passes is kept.
+
+    Before any code is run, it's parsed and checked for `func_name` and for imports of `forbidden_imports`.
+    With repair=True, retries only send the task, the latest code and a summary of its error, instead of the whole
+    conversation, so the prompt stays about the same size on every attempt.
+
+    With a Tracer (see tracing/), the whole call and each attempt are recorded as spans.
+    """
+    with _span(tracer, 'generate_function', func_name=func_name, model=model) as span:
+        if cache is not None:
+            key = FunctionCache.key(function_description, func_name, model, tests, time_budget)
+            cached = cache.get(key)
+            if span:
+                span.set(cache='miss' if cached is None else 'hit')
+            if cached is not None:
+                code, compiled = cached
+                if sandbox is not None and proxy:
+                    return SandboxedFunction(sandbox, code, func_name)
+                namespace = {}
+                exec(compiled, namespace)
+                return namespace[func_name]
+
+        messages =[
+            {'role': 'system', 'content': f"Start by stating your assumptions and explaining your approach. Only write the `{func_name}` function, no other code allowed. Include a single code block. Do not call `{func_name}`."},
+            {'role': 'user', 'content': f"Write a python function called `{func_name}`. Here's the description of the function:\n\n" + function_description}
+        ]
+        sampling = {'n': candidates, 'temperature': 0.8} if candidates > 1 else {}
+        # Timing is only needed to check the budget or to pick the fastest candidate
+        timed = repeat if time_budget is not None or candidates > 1 else 0
+
+        retries = 0
+        while retries < max_retries:
+            with _span(tracer, 'generate_function.attempt', attempt=retries + 1, messages=len(messages)) as attempt:
+                responses = backend.complete(messages=messages, model=model, use_cache=True, **sampling)
+                if isinstance(responses, str):
+                    responses = [responses]
+
+                correct = []
+                feedback = None
+                for response in responses:
+                    code = extract_markdown_code_blocks(response)
+                    if not code:
+                        feedback = feedback or (response, None, "I couldn't find any executable code in your response, can you make sure to include a code block?")
+                        continue
+                    code = '\n\n'.join(code)
+                    if debug:
+                        print('#'*120)
+                        print(code)
+                        print('#'*120)
+
+                    problem = static_check(code, func_name, forbidden_imports)
+                    if problem is not None:
+                        feedback = feedback or (response, code, f"Error: {problem}\nCan you rewrite the entire code you wrote and try again?")
+                        continue
+
+                    namespace = {}
+                    compiled = None
+                    try:
+                        if sandbox is None:
+                            compiled = compile(code, '<string>', 'exec')
+                            exec(compiled, namespace)
+                            if not callable(namespace.get(func_name)):
+                                raise NameError(f"The code doesn't define a function called `{func_name}`.")
+                            seconds = check_function(namespace[func_name], tests, timed, time_budget) if tests else None
+                        else:
+                            seconds = sandbox.check(code, func_name, tests, timed, time_budget)
+                    except SandboxError as e:
+                        error_message = str(e)
+                    except Exception as e:
+                        error_message = f"{e}\n\n{traceback.format_exc()}"
+                    else:
+                        error_message = None
+                    if error_message is not None:
+                        if repair:
+                            content = f"Error:\n{summarize_error(error_message)}\nCan you rewrite the entire code you wrote and fix it?"
+                        else:
+                            content = f"Error: I got an error running your code. Here is the full error message:\n{error_message}\nCan you rewrite the entire code you wrote and try again?"
+                        feedback = feedback or (response, code, content)
+                        continue
+                    if debug and seconds is not None:
+                        print(f'Passed the tests in {format_seconds(seconds)}')
+                    correct.append((seconds or 0, response, code, compiled, namespace))
+
+                fast = [c for c in correct if time_budget is None or c[0] <= time_budget]
+                if attempt:
+                    attempt.set(candidates=len(responses), correct=len(correct), accepted=bool(fast))
+            if fast:
+                break
+            if correct:
+                # prefer feedback on the fastest correct candidate over errors from the others
+                seconds, response, code = min(correct, key=lambda c: c[0])[:3]
+                feedback = (response, code, f"Your function passes all the tests, but it takes {format_seconds(seconds)} to run them, and the budget is {format_seconds(time_budget)}. Can you rewrite the entire code to make it faster?")
+            response, code, content = feedback
+            if repair:
+                del messages[2:]
+                if code is not None:
+                    response = f"```python\n{code}\n```"
+            messages.append({'role': 'assistant', 'content': response})
+            messages.append({'role': 'user', 'content': content})
             retries += 1
-            continue
-        break
 
-    if retries >= max_retries:
-        raise Exception("Failed to generate valid code after 3 retries")
-    return namespace[func_name]
+        if span:
+            span.set(retries=retries)
+        if retries >= max_retries:
+            raise Exception(f"Failed to generate valid code after {max_retries} retries")
+        _, _, code, compiled, namespace = min(fast, key=lambda c: c[0])
+        if compiled is None:
+            compiled = compile(code, '<string>', 'exec')
+        if cache is not None:
+            cache.put(key, code, compiled)
+        if sandbox is not None:
+            if proxy:
+                return SandboxedFunction(sandbox, code, func_name)
+            exec(compiled, namespace)
+        return namespace[func_name]
 
 
 if __name__ == '__main__':
+    try:
+        from cassette import from_env
+    except ImportError: # completions/ isn't on the PYTHONPATH, so there's nothing to record or replay with
+        from_env = lambda backend: backend
+
     ### Linked List Example Implementation ###
     class Node:
         def __init__(self, data=None):
@@ -76,7 +370,9 @@ if __name__ == '__main__':
     print("Original List: ")
     print_list(node1)
 
-    func = generate_function("This function reverses a linked list. The list will consist of nodes which have `next` and `prev` attributes. You will be given the head of the list. ", 'rev', debug=True)
+    # The generated code is checked in a sandbox process first, then loaded here since it modifies the list in place
+    with Sandbox(processes=1) as sandbox:
+        func = generate_function("This function reverses a linked list. The list will consist of nodes which have `next` and `prev` attributes. You will be given the head of the list. ", 'rev', debug=True, sandbox=sandbox, backend=from_env(chatgpt))
     reversed_list = func(node1)
 
     print("Reversed List: ")
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import marshal
+import os
+import tempfile
+from importlib.util import MAGIC_NUMBER
+
+
+class FunctionCache:
+    """
+    An on-disk store of generated functions, keyed by the description, function name and model, and the tests and time
+    budget the function was accepted with, if any.
+    Each entry is the source in a .py file and its compiled bytecode in a .bin file, so loading a function skips both
+    the model and the compiler. Bytecode written by another python version is recompiled from the source.
+    Writes are atomic, so several processes can share a directory. Once the directory is over `max_bytes`, the least
+    recently used entries are deleted.
+    """
+    def __init__(self, directory='.codegen_cache', max_bytes=64 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(description, func_name, model, tests=None, time_budget=None):
+        fields = [description, func_name, model]
+        if tests or time_budget is not None:
+            # Test arguments and results can be any values, repr() tells them apart well enough
+            fields += [tests or [], time_budget]
+        return hashlib.sha256(json.dumps(fields, default=repr).encode()).hexdigest()
+
+    def _path(self, key, ext):
+        return os.path.join(self.directory, key + ext)
+
+    def _write(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def get(self, key):
+        """Returns (source, code object), or None if the function isn't cached."""
+        try:
+            with open(self._path(key, '.py'), 'rb') as f:
+                source = f.read()
+        except FileNotFoundError:
+            return None
+        checksum = hashlib.sha256(source).digest()
+        source = source.decode()
+        code = None
+        try:
+            with open(self._path(key, '.bin'), 'rb') as f:
+                data = f.read()
+            # Bytecode from another python version can't be loaded, it's recompiled from the source
+            if data.startswith(MAGIC_NUMBER):
+                stored_checksum, code = marshal.loads(data[len(MAGIC_NUMBER):])
+                if stored_checksum != checksum:
+                    code = None
+        except (FileNotFoundError, EOFError, ValueError, TypeError):
+            code = None
+        if code is None:
+            code = compile(source, '<string>', 'exec')
+            self._write(self._path(key, '.bin'), self._bytecode(source, checksum, code))
+        for ext in ('.py', '.bin'):
+            try:
+                os.utime(self._path(key, ext))
+            except FileNotFoundError:
+                pass
+        return source, code
+
+    @staticmethod
+    def _bytecode(source, checksum, code=None):
+        # The checksum ties the bytecode to the source it was compiled from
+        return MAGIC_NUMBER + marshal.dumps((checksum, code or compile(source, '<string>', 'exec')))
+
+    def put(self, key, source, code=None):
+        """Stores the source and its bytecode in separate files, so the source survives python upgrades."""
+        data = source.encode()
+        self._write(self._path(key, '.py'), data)
+        self._write(self._path(key, '.bin'), self._bytecode(source, hashlib.sha256(data).digest(), code))
+        self.evict()
+
+    def remove(self, key):
+        for ext in ('.py', '.bin'):
+            try:
+                os.remove(self._path(key, ext))
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        # An entry is its source and bytecode files, used as recently as the newest of them
+        entries = {}
+        for entry in os.scandir(self.directory):
+            key, ext = os.path.splitext(entry.name)
+            if ext in ('.py', '.bin'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                mtime, size = entries.get(key, (0, 0))
+                entries[key] = (max(mtime, stat.st_mtime), size + stat.st_size)
+        total = sum(size for _, size in entries.values())
+        for key, (_, size) in sorted(entries.items(), key=lambda item: item[1]):
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
@@ -0,0 +1,173 @@
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import warnings
+from collections import defaultdict, deque
+from collections.abc import Mapping
+
+
+class CassetteDivergence(Exception):
+    pass
+
+
+def _json_default(value):
+    # Read-only message types, e.g. context_management's Message, are serialized like the dicts they stand for
+    return dict(value) if isinstance(value, Mapping) else str(value)
+
+
+def request_digest(messages, model, kwargs):
+    return hashlib.sha256(json.dumps([messages, model, kwargs], sort_keys=True, default=_json_default).encode()).hexdigest()
+
+
+def _common_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def _snippet(message):
+    return 'nothing' if message is None else repr(dict(message))[:120]
+
+
+class Cassette:
+    """
+    Records the completions of a backend to an append-only JSONL file, and replays them without a backend.
+
+    Each line holds one request and its response (text, or a function call with its args), how long it took, and a
+    digest of the request. To keep the file small, a line only stores the messages that come after the ones it
+    shares with the line before it.
+
+    When replaying, a request gets the recorded response of an identical request. If there's none, the prompt has
+    diverged from the recording: the difference with the next recorded request is reported with a warning and kept in
+    `divergences`, and that request's response is used so the session can go on. With strict=True it's raised
+    as a CassetteDivergence instead.
+    """
+    def __init__(self, path, mode='record', backend=None, strict=False):
+        assert mode in ('record', 'replay'), "mode must be 'record' or 'replay'"
+        assert mode == 'replay' or backend is not None, "A backend is needed to record completions."
+        self.path = path
+        self.mode = mode
+        self.backend = backend
+        self.strict = strict
+        self.divergences = []
+        self._lock = threading.Lock()
+        self._last_messages = []
+        self._n_requests = 0
+        if mode == 'replay':
+            self.entries = load(path)
+            self._unplayed = deque(range(len(self.entries)))
+            self._by_digest = defaultdict(deque)
+            for i, entry in enumerate(self.entries):
+                self._by_digest[entry['digest']].append(i)
+
+    def _record(self, messages, model, kwargs, response, latency):
+        messages = [dict(m) for m in messages]
+        # Only the names of the functions are kept, the digest covers the full schemas
+        stored_kwargs = {k: [f['name'] for f in v] if k == 'functions' else v for k, v in kwargs.items()}
+        with self._lock:
+            prefix = _common_prefix(self._last_messages, messages)
+            entry = {
+                'digest': request_digest(messages, model, kwargs), 'model': model, 'prefix': prefix,
+                'messages': messages[prefix:], 'kwargs': stored_kwargs, 'response': response, 'latency': round(latency, 4),
+            }
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry, default=str) + '\n')
+            self._last_messages = messages
+
+    def _replay(self, messages, model, kwargs):
+        messages = [dict(m) for m in messages]
+        digest = request_digest(messages, model, kwargs)
+        with self._lock:
+            self._n_requests += 1
+            if self._by_digest[digest]:
+                i = self._by_digest[digest].popleft()
+                self._unplayed.remove(i)
+                return self.entries[i]['response']
+            if not self._unplayed:
+                raise CassetteDivergence(f"Request {self._n_requests} isn't in the recording, all {len(self.entries)} recorded requests were already replayed.")
+
+            i = self._unplayed.popleft()
+            self._by_digest[self.entries[i]['digest']].remove(i)
+            expected = self.entries[i]
+            idx = _common_prefix(expected['messages_full'], messages)
+            if idx < max(len(messages), len(expected['messages_full'])):
+                got = messages[idx] if idx < len(messages) else None
+                exp = expected['messages_full'][idx] if idx < len(expected['messages_full']) else None
+                report = f"Request {self._n_requests} diverged from recorded request {i + 1} at message {idx}: expected {_snippet(exp)}, got {_snippet(got)}"
+            else:
+                report = f"Request {self._n_requests} diverged from recorded request {i + 1}: the model or completion arguments changed"
+            self.divergences.append(report)
+        if self.strict:
+            raise CassetteDivergence(report)
+        warnings.warn(report)
+        return expected['response']
+
+    def complete(self, messages, model='gpt-4', **kwargs):
+        if self.mode == 'replay':
+            response = self._replay(messages, model, kwargs)
+            return [response] if kwargs.get('stream') else response
+
+        start = time.perf_counter()
+        response = self.backend.complete(messages=messages, model=model, **kwargs)
+        if not kwargs.get('stream') or isinstance(response, str):
+            self._record(messages, model, kwargs, response, time.perf_counter() - start)
+            return response
+        return self._record_stream(messages, model, kwargs, response, start)
+
+    def _record_stream(self, messages, model, kwargs, chunks, start):
+        text = []
+        for chunk in chunks:
+            text.append(chunk)
+            yield chunk
+        self._record(messages, model, kwargs, ''.join(text), time.perf_counter() - start)
+
+    async def acomplete(self, messages, model='gpt-4', **kwargs):
+        if self.mode == 'replay':
+            return self._replay(messages, model, kwargs)
+
+        start = time.perf_counter()
+        if hasattr(self.backend, 'acomplete'):
+            response = await self.backend.acomplete(messages=messages, model=model, **kwargs)
+        else:
+            response = await asyncio.to_thread(self.backend.complete, messages=messages, model=model, **kwargs)
+        self._record(messages, model, kwargs, response, time.perf_counter() - start)
+        return response
+
+
+def load(path):
+    """Reads a cassette, restoring the full list of messages of every request in `messages_full`."""
+    entries, messages = [], []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                messages = messages[:entry['prefix']] + entry['messages']
+                entry['messages_full'] = messages
+                entries.append(entry)
+    return entries
+
+
+def from_env(backend):
+    """
+    Wraps the backend in a Cassette if the CASSETTE environment variable is set to a file path.
+    CASSETTE_MODE is 'record' (the default) or 'replay'.
+    """
+    path = os.environ.get('CASSETTE')
+    if not path:
+        return backend
+    return Cassette(path, mode=os.environ.get('CASSETTE_MODE', 'record'), backend=backend)
+
+
+if __name__ == '__main__':
+    # Summarizes a recording: python cassette.py session.jsonl
+    entries = load(sys.argv[1])
+    chars = sum(len(json.dumps(entry['messages_full'])) for entry in entries)
+    latency = sum(entry['latency'] for entry in entries)
+    print(f"{len(entries)} requests, ~{chars // 4} prompt tokens, {latency:.1f}s recorded latency ({os.path.getsize(sys.argv[1]) / 1024:.1f} KiB on disk)")
@@ -0,0 +1,133 @@
+import asyncio
+import itertools
+import json
+import re
+import threading
+import time
+
+
+def example_args(schema, defs=None):
+    """Builds a value that matches a JSON schema, used to answer function calls without a model."""
+    defs = schema.get('$defs', defs or {})
+    if '$ref' in schema:
+        return example_args(defs[schema['$ref'].split('/')[-1]], defs)
+    for key in ('allOf', 'anyOf', 'oneOf'):
+        if key in schema:
+            return example_args(schema[key][0], defs)
+    if 'enum' in schema:
+        return schema['enum'][0]
+    if 'default' in schema:
+        return schema['default']
+
+    schema_type = schema.get('type', 'object')
+    if schema_type == 'object':
+        return {name: example_args(prop, defs) for name, prop in schema.get('properties', {}).items()}
+    if schema_type == 'array':
+        return [example_args(schema.get('items', {}), defs)]
+    return {'string': 'text', 'integer': 1, 'number': 1.0, 'boolean': False, 'null': None}.get(schema_type)
+
+
+def estimate_tokens(message):
+    """Uses the token count cached on context_management Messages, otherwise estimates ~4 characters per token."""
+    tokens = getattr(message, 'tokens', None)
+    if tokens is None:
+        tokens = 3 + sum(len(value if isinstance(value, str) else str(value)) // 4 + 1 for value in message.values())
+    return tokens
+
+
+class LocalBackend:
+    """
+    A stand-in for chatgpt that runs locally, so reasoners can be tested without the API.
+
+    `responses` is either a list of responses returned in order, or a function called with the same arguments as
+    complete(). A response is a string, or a dict of function call args when a function call is requested.
+    Once the scripted responses run out, text completions return a numbered placeholder and function calls return
+    args generated from the function's JSON schema.
+    `latency` is the number of seconds every completion takes. When streaming, it's the time to the first chunk, and
+    every following chunk (one per word) takes `chunk_latency` seconds.
+    `completion_tokens` pads the placeholder text responses to about that many tokens (one per word).
+    Requests for n > 1 completions get a list of n of them, like from chatgpt: the next n scripted responses, or the
+    function's result if it returns a list.
+
+    `usage` counts the calls and the prompt and completion tokens (see estimate_tokens), and `cpu_time` is the CPU time
+    spent in the backend, so it can be told apart from the framework's own overhead. With record=False, the requests
+    aren't kept in `calls`, so long sessions don't hold on to every prompt.
+    """
+    def __init__(self, responses=None, latency=0.0, chunk_latency=0.0, completion_tokens=None, record=True):
+        self.responses = responses if callable(responses) else iter(responses or [])
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.completion_tokens = completion_tokens
+        self.record = record
+        self.calls = []
+        self.usage = {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+        self.cpu_time = 0.0
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def respond(self, messages, model='gpt-4', functions=None, function_call=None, n=1, **kwargs):
+        start = time.thread_time()
+        prompt_tokens = sum(map(estimate_tokens, messages))
+        if n != 1:
+            kwargs['n'] = n
+        with self._lock:
+            if self.record:
+                self.calls.append({'messages': messages, 'model': model, 'functions': functions, 'function_call': function_call, **kwargs})
+            if callable(self.responses):
+                response = self.responses(messages, model=model, functions=functions, function_call=function_call, **kwargs)
+                # A function can return all n completions at once, otherwise it's called for each of them
+                responses = response if isinstance(response, list) else [response] + [
+                    self.responses(messages, model=model, functions=functions, function_call=function_call, **kwargs) for _ in range(n - 1)]
+            else:
+                responses = [next(self.responses, None) for _ in range(n)]
+            numbers = [next(self._counter) for _ in responses]
+
+        completions = [self._completion(response, number, functions, function_call) for response, number in zip(responses, numbers)]
+        completion_tokens = 0
+        for completion in completions:
+            text = completion if isinstance(completion, str) else json.dumps(completion.get('args'), default=str)
+            completion_tokens += len(text) // 4 + 1
+        with self._lock:
+            self.usage['calls'] += 1
+            self.usage['prompt_tokens'] += prompt_tokens
+            self.usage['completion_tokens'] += completion_tokens
+            self.cpu_time += time.thread_time() - start
+        # Like chatgpt.complete, n > 1 returns a list of completions
+        return completions if n != 1 else completions[0]
+
+    def _completion(self, response, number, functions, function_call):
+        if function_call is None:
+            if response is None:
+                response = f'Local response {number}.' + ' word' * max((self.completion_tokens or 0) - 3, 0)
+            return response
+        if isinstance(response, dict) and response.get('role') == 'function':
+            return response
+        function = next(f for f in functions if f['name'] == function_call['name'])
+        args = example_args(function['parameters']) if response is None else response
+        return {'role': 'function', 'name': function['name'], 'args': args}
+
+    def complete(self, messages, model='gpt-4', **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.respond(messages, model=model, **kwargs)
+
+    async def acomplete(self, messages, model='gpt-4', **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.respond(messages, model=model, **kwargs)
+
+    def stream(self, messages, model='gpt-4', **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        for i, chunk in enumerate(re.findall(r'\s*\S+', self.respond(messages, model=model, **kwargs))):
+            if i and self.chunk_latency:
+                time.sleep(self.chunk_latency)
+            yield chunk
+
+    async def astream(self, messages, model='gpt-4', **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        for i, chunk in enumerate(re.findall(r'\s*\S+', self.respond(messages, model=model, **kwargs))):
+            if i and self.chunk_latency:
+                await asyncio.sleep(self.chunk_latency)
+            yield chunk
@@ -0,0 +1,261 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+
+from local import estimate_tokens
+
+
+# Priority classes, most urgent first. Reasoners send their external dialogue as 'external' and everything they do
+# in the internal monologue (including structured outputs) as 'monologue'.
+PRIORITIES = ('external', 'monologue', 'background')
+
+
+class TokenBucket:
+    """Allows `rate` units per minute on average, in bursts of up to `capacity` (a minute's worth by default)."""
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate / 60
+        self.capacity = capacity or rate
+        self.level = self.capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` can be taken. Amounts bigger than the bucket wait for a full bucket."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.level -= amount
+
+
+class _Request:
+    __slots__ = ('session', 'priority', 'tokens', 'enqueued', 'granted', 'notify')
+
+    def __init__(self, session, priority, tokens, notify):
+        self.session = session
+        self.priority = priority
+        self.tokens = tokens
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.notify = notify
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class Scheduler:
+    """
+    Sends the completions of many sessions to one backend while staying within the account's rate limits.
+
+    Requests wait in a queue until the token buckets for `requests_per_minute` and `tokens_per_minute` allow them,
+    and at most `max_concurrency` run at once. A request is counted as its estimated prompt tokens plus `max_tokens`
+    (or `completion_tokens` when it isn't set) for every completion it asks for.
+    The queue is served by priority class (see PRIORITIES), and within a class round-robin between sessions, so a
+    session with many queued requests can't hold up the others. Requests are never reordered within a session.
+
+    Use session(name) to get a backend for each reasoner, MemoryManager or generate_function call. Reasoners pass
+    the priority of each completion, other callers get the session's default priority.
+    """
+    accepts_priority = True
+
+    def __init__(self, backend, requests_per_minute=None, tokens_per_minute=None, max_concurrency=None,
+                 completion_tokens=256, clock=time.monotonic):
+        self.backend = backend
+        self.requests_bucket = TokenBucket(requests_per_minute, clock=clock) if requests_per_minute else None
+        self.tokens_bucket = TokenBucket(tokens_per_minute, clock=clock) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.completion_tokens = completion_tokens
+        self._lock = threading.Lock()
+        # One queue per priority class: session -> deque of requests, in round-robin order
+        self._queues = [OrderedDict() for _ in PRIORITIES]
+        self._queued = 0
+        self._running = 0
+        self._timer = None
+        self._stats = {'granted': 0, 'completed': 0, 'wait': 0.0, 'max_wait': 0.0, 'peak_queued': 0}
+
+    def session(self, name, priority='background'):
+        return SchedulerSession(self, name, priority)
+
+    def _estimate(self, messages, kwargs):
+        return sum(map(estimate_tokens, messages)) + kwargs.get('max_tokens', self.completion_tokens) * kwargs.get('n', 1)
+
+    def _submit(self, messages, session, priority, kwargs, notify):
+        request = _Request(session, PRIORITIES.index(priority), self._estimate(messages, kwargs), notify)
+        with self._lock:
+            queue = self._queues[request.priority]
+            if session not in queue:
+                queue[session] = deque()
+            queue[session].append(request)
+            self._queued += 1
+            self._stats['peak_queued'] = max(self._stats['peak_queued'], self._queued)
+            self._dispatch()
+        return request
+
+    def _dispatch(self):
+        # Grants queued requests while there's capacity, called with the lock held
+        while self.max_concurrency is None or self._running < self.max_concurrency:
+            queue = next((queue for queue in self._queues if queue), None)
+            if queue is None:
+                return
+            session, requests = next(iter(queue.items()))
+            request = requests[0]
+            wait = max(
+                self.requests_bucket.wait_time(1) if self.requests_bucket else 0.0,
+                self.tokens_bucket.wait_time(request.tokens) if self.tokens_bucket else 0.0,
+            )
+            if wait > 0:
+                self._wake_in(wait)
+                return
+
+            requests.popleft()
+            if requests:
+                queue.move_to_end(session)
+            else:
+                del queue[session]
+            self._queued -= 1
+            if self.requests_bucket:
+                self.requests_bucket.take(1)
+            if self.tokens_bucket:
+                self.tokens_bucket.take(request.tokens)
+            self._running += 1
+            request.granted = True
+            waited = time.monotonic() - request.enqueued
+            self._stats['granted'] += 1
+            self._stats['wait'] += waited
+            self._stats['max_wait'] = max(self._stats['max_wait'], waited)
+            request.notify()
+
+    def _wake_in(self, seconds):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(seconds, self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._dispatch()
+
+    def _release(self):
+        with self._lock:
+            self._running -= 1
+            self._stats['completed'] += 1
+            self._dispatch()
+
+    def _withdraw(self, request):
+        # Removes a request that's given up waiting, or releases its slot if it was granted in the meantime
+        with self._lock:
+            if not request.granted:
+                requests = self._queues[request.priority].get(request.session)
+                if requests is not None and request in requests:
+                    requests.remove(request)
+                    self._queued -= 1
+                    if not requests:
+                        del self._queues[request.priority][request.session]
+                return
+        self._release()
+
+    def _acquire(self, messages, session, priority, kwargs):
+        event = threading.Event()
+        request = self._submit(messages, session, priority, kwargs, event.set)
+        try:
+            event.wait()
+        except BaseException:
+            self._withdraw(request)
+            raise
+
+    async def _aacquire(self, messages, session, priority, kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        request = self._submit(messages, session, priority, kwargs, lambda: loop.call_soon_threadsafe(_resolve, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            self._withdraw(request)
+            raise
+
+    def complete(self, messages, model='gpt-4', session=None, priority='background', **kwargs):
+        if kwargs.get('stream'):
+            return self._complete_stream(messages, model, session, priority, kwargs)
+        self._acquire(messages, session, priority, kwargs)
+        try:
+            return self.backend.complete(messages=messages, model=model, **kwargs)
+        finally:
+            self._release()
+
+    def _complete_stream(self, messages, model, session, priority, kwargs):
+        # Streams take their slot once they're started and keep it until they're consumed or closed, so a stream
+        # that's never started doesn't hold one
+        self._acquire(messages, session, priority, kwargs)
+        try:
+            response = self.backend.complete(messages=messages, model=model, **kwargs)
+            if isinstance(response, str):
+                yield response
+            else:
+                yield from response
+        finally:
+            self._release()
+
+    def stream(self, messages, model='gpt-4', session=None, priority='background', **kwargs):
+        if not hasattr(self.backend, 'stream'):
+            yield from self._complete_stream(messages, model, session, priority, {**kwargs, 'stream': True})
+            return
+        self._acquire(messages, session, priority, kwargs)
+        try:
+            yield from self.backend.stream(messages=messages, model=model, **kwargs)
+        finally:
+            self._release()
+
+    async def acomplete(self, messages, model='gpt-4', session=None, priority='background', **kwargs):
+        await self._aacquire(messages, session, priority, kwargs)
+        try:
+            if hasattr(self.backend, 'acomplete'):
+                return await self.backend.acomplete(messages=messages, model=model, **kwargs)
+            return await asyncio.to_thread(self.backend.complete, messages=messages, model=model, **kwargs)
+        finally:
+            self._release()
+
+    def metrics(self):
+        """Queue depths by priority class, the number of sessions waiting, and how long requests waited so far."""
+        with self._lock:
+            stats = dict(self._stats)
+            return {
+                'queued': self._queued,
+                'queued_by_priority': {name: sum(map(len, queue.values())) for name, queue in zip(PRIORITIES, self._queues)},
+                'sessions_waiting': len({session for queue in self._queues for session in queue}),
+                'running': self._running,
+                'completed': stats['completed'],
+                'peak_queued': stats['peak_queued'],
+                'mean_wait': stats['wait'] / stats['granted'] if stats['granted'] else 0.0,
+                'max_wait': stats['max_wait'],
+            }
+
+
+class SchedulerSession:
+    """A backend for one session, which sends its completions through the scheduler."""
+    accepts_priority = True
+
+    def __init__(self, scheduler, name, priority='background'):
+        self.scheduler = scheduler
+        self.name = name
+        self.priority = priority
+
+    def complete(self, messages, model='gpt-4', priority=None, **kwargs):
+        return self.scheduler.complete(messages, model, session=self.name, priority=priority or self.priority, **kwargs)
+
+    async def acomplete(self, messages, model='gpt-4', priority=None, **kwargs):
+        return await self.scheduler.acomplete(messages, model, session=self.name, priority=priority or self.priority, **kwargs)
+
+    def stream(self, messages, model='gpt-4', priority=None, **kwargs):
+        return self.scheduler.stream(messages, model, session=self.name, priority=priority or self.priority, **kwargs)
@@ -0,0 +1,126 @@
+import asyncio
+import copy
+import threading
+
+from cassette import request_digest
+
+
+# Scheduler arguments (see scheduler.py) that don't change the completion, so requests that only differ in them are coalesced
+SCHEDULING_KWARGS = frozenset({'session', 'priority'})
+
+
+class _Flight:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _share(result):
+    # Every caller gets its own copy of a function call, so one can't modify another's
+    return result if isinstance(result, str) else copy.deepcopy(result)
+
+
+class SingleFlight:
+    """
+    Coalesces identical requests that are in flight at the same time into one call to the backend.
+
+    While a request runs, identical requests (same messages, model and arguments) wait for it and get its result.
+    If it raises, they raise the same exception. If the caller that made the call is interrupted instead, one of the
+    waiting callers makes the call again. Async callers share a task: a caller that's cancelled stops waiting, and the
+    call itself is only cancelled when every caller waiting on it is.
+
+    Only deterministic requests are coalesced: requests sampled with a temperature above 0 are expected to differ and
+    are passed through, like streams. `coalesced` counts the requests that didn't make their own call.
+    Everything else, e.g. stream() or accepts_priority, is forwarded to the backend.
+
+    Requests that only differ in SCHEDULING_KWARGS are coalesced, and the call is made with the first caller's. To
+    coalesce requests across the sessions of a Scheduler, put the SingleFlight between the sessions and the scheduler:
+    SchedulerSession(SingleFlight(scheduler), name). Under the scheduler, every waiting request would still take a turn.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.coalesced = 0
+        self._flights = {}
+        self._aflights = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    @staticmethod
+    def _coalescible(kwargs):
+        return not kwargs.get('stream') and not kwargs.get('temperature')
+
+    @staticmethod
+    def _digest(messages, model, kwargs):
+        return request_digest(messages, model, {k: v for k, v in kwargs.items() if k not in SCHEDULING_KWARGS})
+
+    @property
+    def in_flight(self):
+        return len(self._flights) + len(self._aflights)
+
+    def complete(self, messages, model='gpt-4', **kwargs):
+        if not self._coalescible(kwargs):
+            return self.backend.complete(messages=messages, model=model, **kwargs)
+        key = self._digest(messages, model, kwargs)
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+                else:
+                    self.coalesced += 1
+            if leader:
+                try:
+                    result = self.backend.complete(messages=messages, model=model, **kwargs)
+                    # The waiters copy their results from a copy of their own, since the leader's caller can modify result
+                    flight.result = _share(result)
+                    return result
+                except BaseException as e:
+                    flight.error = e
+                    raise
+                finally:
+                    with self._lock:
+                        del self._flights[key]
+                    flight.event.set()
+
+            flight.event.wait()
+            if flight.error is None:
+                return _share(flight.result)
+            if isinstance(flight.error, Exception):
+                raise flight.error
+            # The caller making the call was interrupted, try again
+            with self._lock:
+                self.coalesced -= 1
+
+    async def _acall(self, messages, model, kwargs):
+        if hasattr(self.backend, 'acomplete'):
+            return await self.backend.acomplete(messages=messages, model=model, **kwargs)
+        return await asyncio.to_thread(self.backend.complete, messages=messages, model=model, **kwargs)
+
+    async def acomplete(self, messages, model='gpt-4', **kwargs):
+        if not self._coalescible(kwargs):
+            return await self._acall(messages, model, kwargs)
+        # Tasks can only be shared within an event loop
+        key = (id(asyncio.get_running_loop()), self._digest(messages, model, kwargs))
+        flight = self._aflights.get(key)
+        leader = flight is None
+        if leader:
+            flight = self._aflights[key] = [asyncio.ensure_future(self._acall(messages, model, kwargs)), 0]
+            flight[0].add_done_callback(lambda _: self._aflights.pop(key) if self._aflights.get(key) is flight else None)
+        else:
+            self.coalesced += 1
+        task = flight[0]
+        flight[1] += 1
+        try:
+            result = await asyncio.shield(task)
+        finally:
+            flight[1] -= 1
+            if flight[1] == 0 and not task.done():
+                task.cancel()
+        # Every caller, the leader's too, gets a copy of the task's result, which they all share
+        return _share(result)
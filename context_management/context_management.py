@@ -1,24 +1,756 @@
+import asyncio
+import hashlib
+import json
+import re
+import sys
+import threading
+import weakref
+from collections.abc import Mapping, MutableSequence
+from concurrent.futures import ThreadPoolExecutor, wait
+from types import MappingProxyType
+
 import chatgpt
 
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_encoding = None
+_EMPTY_HASH = hashlib.sha256().digest()
+# Leading tags like "[Internal Monologue]: " or '[Loaded Memory "date"]: '
+_PREFIX = re.compile(r'\[[^\]\n]{1,100}\]: ')
+
+
+def count_tokens(message):
+    """Counts the prompt tokens used by a message. Falls back to a ~4 characters per token estimate if tiktoken isn't installed."""
+    global _encoding
+    if tiktoken is not None and _encoding is None:
+        _encoding = tiktoken.get_encoding('cl100k_base')
+    tokens = 3 # every message is wrapped in <|start|>{role/name}\n{content}<|end|>
+    for key, value in message.items():
+        value = value if isinstance(value, str) else str(value)
+        tokens += len(_encoding.encode(value)) if _encoding else len(value) // 4 + 1
+        if key == 'name':
+            tokens += 1
+    return tokens
+
+
+def _take(fields, key):
+    # Pops a string field, anything else stays where it is
+    value = fields.get(key)
+    if type(value) is not str:
+        return None
+    del fields[key]
+    return sys.intern(value)
+
+
+class Message(Mapping):
+    """
+    A chat message that can't be modified in place, so it can be shared between branches.
+    Use `message.replace(content=...)` to get an updated copy.
+
+    It reads like a dict, but it's stored compactly since contexts can be kept around for a long time: the role and
+    name are interned, and a leading tag like "[Internal Monologue]: " is interned and kept apart from the rest of the
+    content, in `prefix` and `body`. Other keys are kept in a dict in `extra`. to_dict() builds the dict the API
+    expects, which is done for the whole list right before a completion (see MessageList.to_dicts()).
+    """
+    __slots__ = ('role', 'name', 'prefix', 'body', 'extra', '_tokens', '_digest')
+
+    def __init__(self, message=(), **fields):
+        fields = dict(message, **fields)
+        self.role = _take(fields, 'role')
+        self.name = _take(fields, 'name')
+        content = fields.get('content')
+        if type(content) is str:
+            del fields['content']
+            match = _PREFIX.match(content)
+            self.prefix = sys.intern(match.group()) if match else ''
+            self.body = content[match.end():] if match else content
+        else:
+            self.prefix = ''
+            self.body = None
+        self.extra = fields or None
+
+    def __getitem__(self, key):
+        if key == 'content' and self.body is not None:
+            return self.prefix + self.body if self.prefix else self.body
+        if key == 'role' and self.role is not None:
+            return self.role
+        if key == 'name' and self.name is not None:
+            return self.name
+        if self.extra is not None:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        if self.role is not None:
+            yield 'role'
+        if self.body is not None:
+            yield 'content'
+        if self.name is not None:
+            yield 'name'
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        return (self.role is not None) + (self.body is not None) + (self.name is not None) + len(self.extra or ())
+
+    def __contains__(self, key):
+        return (key == 'role' and self.role is not None or key == 'content' and self.body is not None
+                or key == 'name' and self.name is not None or self.extra is not None and key in self.extra)
+
+    def to_dict(self):
+        if self.name is None and self.extra is None and self.role is not None and self.body is not None:
+            return {'role': self.role, 'content': self.prefix + self.body if self.prefix else self.body}
+        message = {}
+        if self.role is not None:
+            message['role'] = self.role
+        if self.body is not None:
+            message['content'] = self.prefix + self.body if self.prefix else self.body
+        if self.name is not None:
+            message['name'] = self.name
+        if self.extra is not None:
+            message.update(self.extra)
+        return message
+
+    @property
+    def tokens(self):
+        try:
+            return self._tokens
+        except AttributeError:
+            self._tokens = count_tokens(self)
+            return self._tokens
+
+    @property
+    def digest(self):
+        try:
+            return self._digest
+        except AttributeError:
+            self._digest = hashlib.sha256(json.dumps(self.to_dict(), sort_keys=True, default=str).encode()).digest()
+            return self._digest
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Messages are immutable, use message.replace(...) and assign the copy instead.")
+
+    __setitem__ = __delitem__ = _readonly
+
+    def replace(self, **changes):
+        return Message(self, **changes)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return Message, (self.to_dict(),)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+def _size(piece):
+    return len(piece) if type(piece) is list else piece[2] - piece[1]
+
+
+class MessageList(MutableSequence):
+    """
+    A list of messages that can be branched in O(1).
+
+    The list is stored as a sequence of pieces. A piece is either a list of messages owned by this
+    MessageList, or a (parent, start, stop) range of the MessageList it was branched from. Branches
+    only store what they add or change, so the parent history is shared, never copied.
+
+    Parents keep weak references to their branches. If a parent is modified while it has live
+    branches, it first moves its pieces into a frozen snapshot that the branches are re-pointed to,
+    so the branches never see the change.
+
+    Messages can be inserted into a named slot. The slot index is kept up to date as messages are
+    inserted and removed, so a slotted message can be found without scanning the list.
+
+    `tokens` is a running total of the message token counts, which are cached on each message.
+
+    `digest` is the last link of a hash chain over the messages, which makes a cheap cache key for the whole list.
+    The chain is extended lazily, so appending costs O(1), and other changes only discard the hashes from the changed
+    index on. A branch reuses its parent's hashes for the prefix they share.
+    """
+    MAX_DEPTH = 32
+
+    def __init__(self, messages=()):
+        messages = [m if isinstance(m, Message) else Message(m) for m in messages]
+        self._pieces = [messages] if messages else []
+        self._len = len(messages)
+        self._tokens = sum(m.tokens for m in messages)
+        self._parent = None
+        self._children = weakref.WeakSet()
+        self._depth = 0
+        self._slots = {}
+        self._slots_shared = False
+        # Hashes before _base_len are looked up in _base, _hashes holds the ones after it
+        self._base = None
+        self._base_len = 0
+        self._hashes = []
+
+    @property
+    def tokens(self):
+        return self._tokens
+
+    @property
+    def depth(self):
+        # How many lists deep the storage is shared, at most MAX_DEPTH
+        return self._depth
+
+    @property
+    def digest(self):
+        return self._prefix_hash(self._len - 1).hex()
+
+    def _prefix_hash(self, k):
+        # The chained hash of messages 0..k
+        if k < 0:
+            return _EMPTY_HASH
+        # Walks down the bases until a known hash, then extends the chains on the way back up
+        pending = []
+        store, i = self, k
+        while True:
+            while i < store._base_len:
+                store = store._base
+            start, hashes = store._base_len, store._hashes
+            if i - start < len(hashes):
+                break
+            pending.append((store, i))
+            if hashes or not start:
+                break
+            store, i = store._base, start - 1
+        for store, i in reversed(pending):
+            start, hashes = store._base_len, store._hashes
+            pos = start + len(hashes)
+            h = hashes[-1] if hashes else store._base._prefix_hash(start - 1) if start else _EMPTY_HASH
+            new = []
+            for message in store._iter(pos, i + 1):
+                h = hashlib.sha256(h + message.digest).digest()
+                new.append(h)
+            hashes[pos - start:] = new
+
+        store = self
+        while k < store._base_len:
+            store = store._base
+        return store._hashes[k - store._base_len]
+
+    def _invalidate_hashes(self, i):
+        if i < self._base_len:
+            self._base_len = i
+            self._hashes = []
+            if not i:
+                self._base = None
+        else:
+            del self._hashes[i - self._base_len:]
+
+    @property
+    def slots(self):
+        return MappingProxyType(self._slots)
+
+    def slot(self, name):
+        return self._slots.get(name)
+
+    def set_slot(self, name, i):
+        """Puts the message at index i in a slot, replacing the slot's message if it had one. i=None empties the slot."""
+        if i is not None:
+            self._set_slot(name, self._index(i))
+        elif name in self._slots:
+            self._slots = {slot: idx for slot, idx in self._slots.items() if slot != name}
+            self._slots_shared = False
+
+    def _shift_slots(self, i, delta):
+        if self._slots_shared:
+            self._slots = dict(self._slots)
+            self._slots_shared = False
+        if delta < 0:
+            self._slots = {name: idx for name, idx in self._slots.items() if idx != i}
+        for name, idx in self._slots.items():
+            if idx >= i:
+                self._slots[name] = idx + delta
+
+    def branch(self) -> 'MessageList':
+        child = MessageList()
+        if self._len:
+            child._pieces = [(self, 0, self._len)]
+            child._len = self._len
+            child._tokens = self._tokens
+            child._parent = self
+            child._depth = self._depth + 1
+            child._slots = self._slots
+            child._slots_shared = self._slots_shared = True
+            child._base = self
+            child._base_len = self._len
+            self._children.add(child)
+            if child._depth > self.MAX_DEPTH:
+                child.flatten()
+        return child
+
+    def _unlink(self):
+        if self._parent is not None:
+            self._parent._children.discard(self)
+            self._parent = None
+
+    def _detach(self):
+        if not self._children:
+            return
+        self._slots_shared = True
+        snapshot = MessageList.__new__(MessageList)
+        snapshot.__dict__.update(self.__dict__)
+        if self._parent is not None:
+            self._parent._children.discard(self)
+            self._parent._children.add(snapshot)
+        for child in snapshot._children:
+            child._pieces = [(snapshot, p[1], p[2]) if type(p) is tuple else p for p in child._pieces]
+            child._parent = snapshot
+            if child._base is self:
+                child._base = snapshot
+
+        self._pieces = [(snapshot, 0, self._len)]
+        self._parent = snapshot
+        self._base = snapshot
+        self._base_len = self._len
+        self._hashes = []
+        self._children = weakref.WeakSet()
+        self._depth = snapshot._depth + 1
+        snapshot._children.add(self)
+        if self._depth > self.MAX_DEPTH:
+            self.flatten()
+
+    def flatten(self):
+        """Copies the messages into a list of its own, so the list doesn't share the storage of the list it was branched from."""
+        self._pieces = [list(self)] if self._len else []
+        self._unlink()
+        self._depth = 0
+        self._base = None
+        self._base_len = 0
+        self._hashes = []
+
+    def _locate(self, i):
+        for j, piece in enumerate(self._pieces):
+            n = _size(piece)
+            if i < n:
+                return j, i
+            i -= n
+        return len(self._pieces), 0
+
+    def _get(self, i):
+        store = self
+        while True:
+            j, off = store._locate(i)
+            piece = store._pieces[j]
+            if type(piece) is list:
+                return piece[off]
+            store, i = piece[0], piece[1] + off
+
+    def _iter(self, start, stop):
+        # Ranges of parents are expanded on a stack rather than recursively, so deep branches can't overflow
+        stack = [(self, start, stop)]
+        while stack:
+            piece, start, stop = stack.pop()
+            if type(piece) is list:
+                yield from piece[start:stop]
+                continue
+            ranges, pos = [], 0
+            for sub in piece._pieces:
+                if pos >= stop:
+                    break
+                n = _size(sub)
+                if pos + n > start:
+                    lo, hi = max(start - pos, 0), min(stop - pos, n)
+                    ranges.append((sub, lo, hi) if type(sub) is list else (sub[0], sub[1] + lo, sub[1] + hi))
+                pos += n
+            stack.extend(reversed(ranges))
+
+    def _index(self, i):
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError('message index out of range')
+        return i
+
+    def _split(self, j, off, replacement):
+        # Replaces the message at `off` in the parent range at pieces[j] with `replacement`
+        src, a, b = self._pieces[j]
+        pieces = [(src, a, a + off)] if off else []
+        if replacement is not None:
+            pieces.append([replacement])
+        if a + off + 1 < b:
+            pieces.append((src, a + off + 1, b))
+        self._pieces[j:j+1] = pieces
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return self._iter(0, self._len)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        return self._get(self._index(i))
+
+    def __setitem__(self, i, message):
+        if isinstance(i, slice):
+            # Done message by message like a list, so the slots follow: replaced messages keep theirs, removed ones
+            # lose theirs, and the ones after the slice shift
+            start, stop, step = i.indices(self._len)
+            messages = list(message)
+            if step != 1:
+                indices = range(start, stop, step)
+                if len(messages) != len(indices):
+                    raise ValueError(f'attempt to assign sequence of size {len(messages)} to extended slice of size {len(indices)}')
+                for k, message in zip(indices, messages):
+                    self[k] = message
+                return
+            stop = max(start, stop)
+            for k, message in zip(range(start, stop), messages):
+                self[k] = message
+            if len(messages) < stop - start:
+                del self[start + len(messages):stop]
+            for k, message in enumerate(messages[stop - start:], stop):
+                self.insert(k, message)
+            return
+        i = self._index(i)
+        self._detach()
+        message = message if isinstance(message, Message) else Message(message)
+        j, off = self._locate(i)
+        piece = self._pieces[j]
+        if type(piece) is list:
+            old = piece[off]
+            piece[off] = message
+        else:
+            old = piece[0]._get(piece[1] + off)
+            self._split(j, off, message)
+        self._tokens += message.tokens - old.tokens
+        self._invalidate_hashes(i)
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            for k in sorted(range(*i.indices(self._len)), reverse=True):
+                del self[k]
+            return
+        i = self._index(i)
+        self._detach()
+        j, off = self._locate(i)
+        piece = self._pieces[j]
+        if type(piece) is list:
+            old = piece.pop(off)
+            if not piece:
+                del self._pieces[j]
+        else:
+            old = piece[0]._get(piece[1] + off)
+            self._split(j, off, None)
+        self._len -= 1
+        self._tokens -= old.tokens
+        self._invalidate_hashes(i)
+        if self._slots:
+            self._shift_slots(i, -1)
+
+    def insert(self, i, message, slot=None):
+        if i < 0:
+            i = max(i + self._len, 0)
+        i = min(i, self._len)
+        if i == self._len:
+            return self.append(message, slot)
+        self._detach()
+        message = message if isinstance(message, Message) else Message(message)
+        j, off = self._locate(i)
+        piece = self._pieces[j]
+        if off == 0 and j > 0 and type(self._pieces[j-1]) is list:
+            self._pieces[j-1].append(message)
+        elif type(piece) is list:
+            piece.insert(off, message)
+        else:
+            src, a, b = piece
+            self._pieces[j:j+1] = ([(src, a, a + off)] if off else []) + [[message], (src, a + off, b)]
+        self._len += 1
+        self._tokens += message.tokens
+        self._invalidate_hashes(i)
+        if self._slots:
+            self._shift_slots(i, 1)
+        if slot is not None:
+            self._set_slot(slot, i)
+
+    def _set_slot(self, name, i):
+        if self._slots_shared:
+            self._slots = dict(self._slots)
+            self._slots_shared = False
+        self._slots[name] = i
+
+    def append(self, message, slot=None):
+        self._detach()
+        message = message if isinstance(message, Message) else Message(message)
+        if self._pieces and type(self._pieces[-1]) is list:
+            self._pieces[-1].append(message)
+        else:
+            self._pieces.append([message])
+        self._len += 1
+        self._tokens += message.tokens
+        if slot is not None:
+            self._set_slot(slot, self._len - 1)
+
+    def clear(self):
+        self._detach()
+        self._unlink()
+        self._pieces = []
+        self._len = 0
+        self._tokens = 0
+        self._depth = 0
+        self._slots = {}
+        self._slots_shared = False
+        self._base = None
+        self._base_len = 0
+        self._hashes = []
+
+    def to_dicts(self):
+        """The messages as plain dicts, in the format the API expects."""
+        return [message.to_dict() for message in self._iter(0, self._len)]
+
+    def __repr__(self):
+        return f'MessageList({list(self)!r})'
+
+
+class EvictionPolicy:
+    """
+    Trims a MessageList so it fits in `max_tokens`.
+
+    System messages (which includes loaded memories) and slotted messages are pinned and never evicted.
+    First, the monologue messages of the current turn are capped to `max_monologue_tokens` by dropping the oldest ones.
+    Then whole turns are dropped, oldest first, until the messages fit. The current turn is never dropped.
+    Only the current turn and the evicted messages are scanned, so this stays cheap on very long histories.
+    """
+    def __init__(self, max_tokens, max_monologue_tokens=None, monologue_prefix='[Internal Monologue]: '):
+        self.max_tokens = max_tokens
+        self.max_monologue_tokens = max_monologue_tokens
+        self.monologue_prefix = monologue_prefix
+
+    def is_pinned(self, messages, idx):
+        return messages[idx]['role'] == 'system' or idx in messages.slots.values()
+
+    def is_monologue(self, message):
+        return message['role'] == 'assistant' and message['content'].startswith(self.monologue_prefix)
+
+    def apply(self, messages):
+        if self.max_monologue_tokens is not None:
+            self.cap_monologue(messages)
+
+        start = 0
+        while messages.tokens > self.max_tokens:
+            while start < len(messages) and self.is_pinned(messages, start):
+                start += 1
+            # A turn starts at a user message and lasts until the next one
+            end = start + 1
+            while end < len(messages) and messages[end]['role'] != 'user':
+                end += 1
+            if end >= len(messages):
+                break
+            for idx in range(end - 1, start - 1, -1):
+                if not self.is_pinned(messages, idx):
+                    del messages[idx]
+
+    def cap_monologue(self, messages):
+        idx, segment, tokens = len(messages) - 1, [], 0
+        while idx >= 0 and messages[idx]['role'] != 'user':
+            if self.is_monologue(messages[idx]):
+                segment.append(idx)
+                tokens += messages[idx].tokens
+            idx -= 1
+        # segment is ordered newest first, always keep the newest monologue message
+        for removed, idx in enumerate(segment[:0:-1]):
+            if tokens <= self.max_monologue_tokens:
+                break
+            tokens -= messages[idx - removed].tokens
+            del messages[idx - removed]
+
+
+class MonologueCompaction:
+    """
+    Compacts finished internal monologue segments, which are marked by `enter_name` and `exit_name` function messages.
+
+    The last `keep_last` finished segments are kept as they are, and so is a segment that nothing follows yet, since
+    the next completion is the one that uses it. Older ones are dropped, or with mode='summarize', replaced by a single
+    monologue message. Only the assistant and function messages of a segment are compacted, anything else in it (e.g.
+    a user message that came in during the monologue) is kept, after the summary. The summary is `summarize(segment_messages)` if given (e.g. a completion
+    that summarizes the reasoning), otherwise the model's last thought in the segment, cut to `summary_chars`.
+    Compaction runs whenever a segment is finished, and also before a completion if the messages are over `max_tokens`.
+    """
+    def __init__(self, keep_last=2, mode='drop', summarize=None, max_tokens=None, summary_chars=300,
+                 monologue_prefix='[Internal Monologue]: ', enter_name='enter_monologue', exit_name='exit_monologue'):
+        assert mode in ('drop', 'summarize'), "mode must be 'drop' or 'summarize'"
+        self.keep_last = keep_last
+        self.mode = mode
+        self.summarize = summarize
+        self.max_tokens = max_tokens
+        self.summary_chars = summary_chars
+        self.monologue_prefix = monologue_prefix
+        self.enter_name = enter_name
+        self.exit_name = exit_name
+
+    def _is_marker(self, message, name):
+        return message['role'] == 'function' and message.get('name') == name
+
+    def segments(self, messages):
+        """Returns the (start, stop) ranges of the finished segments."""
+        segments, start = [], None
+        for i, message in enumerate(messages):
+            if self._is_marker(message, self.enter_name):
+                start = i
+            elif start is not None and self._is_marker(message, self.exit_name):
+                segments.append((start, i + 1))
+                start = None
+        return segments
+
+    def _summary(self, segment):
+        if self.summarize is not None:
+            text = self.summarize(segment)
+        else:
+            # A segment opens with the enter marker and an announcement, and closes with the thought that led out of it
+            # (the caller's, e.g. "I should respond with..."), an announcement and the exit marker. The last thought in
+            # between is the model's latest reasoning.
+            thoughts = [m['content'][len(self.monologue_prefix):] for m in segment[2:-3] if m['role'] == 'assistant' and m['content'].startswith(self.monologue_prefix)]
+            text = thoughts[-1] if thoughts else ''
+            if len(text) > self.summary_chars:
+                text = text[:self.summary_chars - 3] + '...'
+        return Message({'role': 'assistant', 'content': f'{self.monologue_prefix}(Summary of earlier reasoning) {text}'})
+
+    def plan(self, messages):
+        """
+        Decides what to compact. Returns a list of (segment messages, replacement messages).
+        This is where summaries are made, so it can run on a copy of the messages in another thread.
+        """
+        segments = self.segments(messages)
+        if self.keep_last:
+            segments = segments[:-self.keep_last]
+        plan = []
+        for start, stop in segments:
+            if stop >= len(messages):
+                continue
+            segment = messages[start:stop]
+            replacement = [self._summary(segment)] if self.mode == 'summarize' else []
+            replacement += [m for m in segment if m['role'] not in ('assistant', 'function')]
+            plan.append((segment, replacement))
+        return plan
+
+    def apply(self, messages, plan):
+        """Applies a plan. Segments are found by identity, so the plan can be made on a copy, and segments that changed since are skipped."""
+        if not plan:
+            return
+        starts = {id(m): i for i, m in enumerate(messages) if self._is_marker(m, self.enter_name)}
+        for segment, replacement in reversed(plan):
+            i = starts.get(id(segment[0]))
+            if i is None or i + len(segment) > len(messages) or any(messages[i + k] is not m for k, m in enumerate(segment)):
+                continue
+            del messages[i:i + len(segment)]
+            for k, message in enumerate(replacement):
+                messages.insert(i + k, message)
+
+    def compact(self, messages):
+        self.apply(messages, self.plan(messages))
+
+
 class Context():
-    def __init__(self, messages=None):
-        self.messages = messages or []
-        
-    def add_message(self, role, content, name=None, idx=None):
+    def __init__(self, messages=None, eviction=None, tracer=None):
+        self.messages = MessageList(messages or [])
+        self.eviction = eviction
+        # An optional Tracer (see tracing/), used to trace branches and memory loading
+        self.tracer = tracer
+        # Set when a fan_out() times out, long running branch bodies can check it to stop early
+        self.cancelled = threading.Event()
+
+    def add_message(self, role, content, name=None, idx=None, slot=None):
         message = {'role': role, 'content': content}
         if name:
             message['name'] = name
         if idx is None:
-            self.messages.append(message)
+            self.messages.append(message, slot=slot)
         else:
-            self.messages.insert(idx, message)
+            self.messages.insert(idx, message, slot=slot)
 
     def clear(self):
-        self.messages = []
+        self.messages = MessageList()
+
+    @property
+    def tokens(self):
+        return self.messages.tokens
+
+    @property
+    def digest(self):
+        """A hash of the messages, see MessageList."""
+        return self.messages.digest
+
+    def fit(self):
+        """Applies the eviction policy, call this before each completion."""
+        if self.eviction is not None:
+            self.eviction.apply(self.messages)
 
     def branch(self) -> 'ContextBranch':
         return ContextBranch(self)
 
+    def fork(self) -> 'Context':
+        """Returns a new Context on a branch of this context's messages. Unlike branch(), the fork can be kept and used concurrently."""
+        context = Context(eviction=self.eviction, tracer=self.tracer)
+        context.messages = self.messages.branch()
+        return context
+
+    def fan_out(self, variants, fn, max_concurrency=None, timeout=None):
+        """
+        Calls fn(context, variant) for every variant concurrently on a thread pool, each with its own fork of this context.
+        Returns the results in the same order as the variants. If a branch raises, the exception is returned in place of
+        its result, so one failing branch doesn't affect the others. Branches that haven't finished after `timeout`
+        seconds are cancelled and a TimeoutError is returned in their place.
+        """
+        variants = list(variants)
+        forks = [self.fork() for _ in variants]
+        executor = ThreadPoolExecutor(max_workers=max_concurrency or max(len(variants), 1))
+        futures = [executor.submit(fn, fork, variant) for fork, variant in zip(forks, variants)]
+        try:
+            wait(futures, timeout)
+        finally:
+            for fork, future in zip(forks, futures):
+                if not future.done():
+                    fork.cancelled.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        results = []
+        for future in futures:
+            if not future.done() or future.cancelled():
+                results.append(TimeoutError(f'Branch did not finish within {timeout} seconds.'))
+            else:
+                results.append(future.exception() or future.result())
+        return results
+
+    async def afan_out(self, variants, fn, max_concurrency=None, timeout=None):
+        """Async version of fan_out() for coroutine functions. Unfinished branches are cancelled on timeout or when this call is cancelled."""
+        semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+
+        async def run(context, variant):
+            if semaphore is None:
+                return await fn(context, variant)
+            async with semaphore:
+                return await fn(context, variant)
+
+        tasks = [asyncio.ensure_future(run(self.fork(), variant)) for variant in variants]
+        if not tasks:
+            return []
+        try:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+        finally:
+            for task in tasks:
+                task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        results = []
+        for task in tasks:
+            if task in pending:
+                results.append(TimeoutError(f'Branch did not finish within {timeout} seconds.'))
+            else:
+                results.append(task.exception() or task.result())
+        return results
+
 
 class ContextBranch(Context):
     def __init__(self, context: Context):
@@ -26,22 +758,37 @@ class ContextBranch(Context):
 
     def __enter__(self):
         self.old_messages = self.context.messages
-        self.context.messages = self.context.messages.copy()
+        self.context.messages = self.old_messages.branch()
+        self.span = self.context.tracer and self.context.tracer.span('branch', messages=len(self.old_messages))
+        if self.span:
+            self.span.__enter__()
 
     def __exit__(self, exc_type, exc_value, traceback):
+        if self.span:
+            self.span.set(branch_messages=len(self.context.messages))
+            self.span.__exit__(exc_type, exc_value, traceback)
         self.context.messages = self.old_messages
 
 
 if __name__ == '__main__':
+    try:
+        from cassette import from_env
+    except ImportError: # completions/ isn't on the PYTHONPATH, so there's nothing to record or replay with
+        from_env = lambda backend: backend
+    backend = from_env(chatgpt) # set CASSETTE=session.jsonl to record the completions, and CASSETTE_MODE=replay to replay them
+
     context = Context()
     context.add_message('user', "What should I do with my life?")
 
-    for sys_msg in [
+    def respond(context, sys_msg):
+        context.add_message('system', sys_msg, idx=0)
+        return backend.complete(context.messages.to_dicts(), model='gpt-4', use_cache=True)
+
+    # Each system prompt gets its own branch, and all the completions run at the same time
+    responses = context.fan_out([
         "You are a based twitter user. Your influences are Paul Graham, Peter Thiel, and Elon Musk.",
         "You are a typical engineering student. You are not too intelligent and mostly follow the herd.",
-    ]:
-        with context.branch():
-            context.add_message('system', sys_msg, idx=0)
-            response = chatgpt.complete(context.messages, model='gpt-4', use_cache=True)
+    ], respond)
+    for response in responses:
         print(response)
         print('\n***\n')
\ No newline at end of file
@@ -1,43 +1,207 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
 import chatgpt
-from context_management import Context
+from context_management import Context, count_tokens
+
+_NO_SPAN = nullcontext()
 
 
 class MemoryManager:
-    def __init__(self, context):
+    def __init__(self, context, cache_size=256, max_workers=8, index=None):
         self.context = context
         self.memories = {}
+        self.ttls = {}
+        # An optional MemoryIndex (see retrieval.py), kept up to date with the memories and used by load_relevant_memories()
+        self.index = index
+
+        # LRU cache of provider results: name -> (value, expiry time)
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self._cache_lock = threading.Lock()
+        self._max_workers = max_workers
+        self._executor = None
 
-    def add_memory(self, name, memory):
-        memory = memory if callable(memory) else (lambda m=memory: m)
+    def add_memory(self, name, memory, ttl=0, description=None):
+        """
+        Registers a memory. `memory` is either a value or a callable that provides the value when the memory is loaded.
+        Provider results are cached for `ttl` seconds. A ttl of 0 calls the provider on every load and None caches the
+        result until the memory is invalidated.
+        With an index, the memory is indexed by its name and its `description`, or its value if it isn't a callable.
+        """
+        if self.index is not None:
+            text = description if description is not None else None if callable(memory) else str(memory)
+            self.index.add(name, name if text is None else f'{name}: {text}')
+        if not callable(memory):
+            memory, ttl = (lambda m=memory: m), None
         self.memories[name] = memory
+        self.ttls[name] = ttl
+        self.invalidate(name)
 
     def remove_memory(self, name):
         if name in self.memories:
             del self.memories[name]
+            del self.ttls[name]
+            self.invalidate(name)
+            if self.index is not None:
+                self.index.remove(name)
+
+    def invalidate(self, *names):
+        with self._cache_lock:
+            if len(names) == 0:
+                self.cache.clear()
+            for name in names:
+                self.cache.pop(name, None)
+
+    def _get_cached(self, name):
+        with self._cache_lock:
+            if name not in self.cache:
+                return None
+            value, expires = self.cache[name]
+            if expires is not None and expires <= time.monotonic():
+                del self.cache[name]
+                return None
+            self.cache.move_to_end(name)
+            return value,
+
+    def _set_cached(self, name, value):
+        ttl = self.ttls[name]
+        if ttl == 0:
+            return
+        with self._cache_lock:
+            self.cache[name] = (value, None if ttl is None else time.monotonic() + ttl)
+            self.cache.move_to_end(name)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def _span(self, name, **attrs):
+        tracer = self.context.tracer
+        return _NO_SPAN if tracer is None else tracer.span(name, **attrs)
+
+    def get_memories(self, *names):
+        """Returns {name: value} for the given memories. Cache misses are evaluated concurrently on a thread pool."""
+        with self._span('get_memories', memories=len(names)) as span:
+            values, missing = {}, []
+            for name in names:
+                cached = self._get_cached(name)
+                if cached is None:
+                    missing.append(name)
+                else:
+                    values[name] = cached[0]
+            if span:
+                span.set(misses=len(missing))
+
+            if len(missing) == 1:
+                results = [self.memories[missing[0]]()]
+            elif missing:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+                results = list(self._executor.map(lambda name: self.memories[name](), missing))
+            else:
+                results = []
+            for name, value in zip(missing, results):
+                self._set_cached(name, value)
+                values[name] = value
+            return values
 
     def load_memories(self, *names):
+        with self._span('load_memories') as span:
+            if len(names) == 0:
+                names = self.memories.keys()
+            names = [name for name in names if name in self.memories]
+            memories = self.get_memories(*names)
+
+            messages = self.context.messages
+            mem_idx = int(len(messages) > 0 and messages[0]['role'] == 'system')
+            for name in names:
+                content = _memory_content(name, memories[name])
+
+                # Loaded memories are kept in named slots, so refreshing one doesn't require searching the context
+                idx = messages.slot('memory:' + name)
+                if idx is not None:
+                    # Replacing a message invalidates the prefix hashes after it, so unchanged memories are left alone
+                    if messages[idx]['content'] != content:
+                        messages[idx] = messages[idx].replace(content=content)
+                else:
+                    self.context.add_message('system', content=content, name='load_memory', idx=mem_idx, slot='memory:' + name)
+                    mem_idx += 1
+            if span:
+                span.set(memories=len(names), messages=len(messages))
+
+    def unload_memories(self, *names):
+        """Removes loaded memories from the context, all of them if no names are given."""
+        messages = self.context.messages
         if len(names) == 0:
-            names = self.memories.keys()
-        
-        mem_idx = int(self.context.messages[0]['role'] =='system')
+            names = [slot[len('memory:'):] for slot in messages.slots if slot.startswith('memory:')]
         for name in names:
-            if name not in self.memories:
-                continue
-            memory = self.memories[name]()
-            
-            found = False
-            prefix = f'[Loaded Memory "{name}"]: '
-            for m in self.context.messages:
-                if m['content'].startswith(prefix):
-                    m['content'] = prefix + memory
-                    found = True
-
-            if not found:
-                self.context.add_message('system', content=f'[Loaded Memory "{name}"]: {memory}', name='load_memory', idx=mem_idx)
-                mem_idx += 1
+            idx = messages.slot('memory:' + name)
+            if idx is not None:
+                del messages[idx]
+
+    def _query(self, recent):
+        # The contents of the last `recent` user and assistant messages
+        messages = self.context.messages
+        texts = []
+        for i in range(len(messages) - 1, -1, -1):
+            if len(texts) == recent:
+                break
+            message = messages[i]
+            if message['role'] in ('user', 'assistant') and isinstance(message.get('content'), str):
+                texts.append(message['content'])
+        return '\n'.join(reversed(texts))
+
+    def retrieve(self, query, k=5, max_tokens=None):
+        """
+        Returns the names of up to k memories most relevant to the query, best first, whose loaded messages fit in
+        `max_tokens` together. Memories that don't fit are skipped in favor of less relevant ones that do.
+        """
+        assert self.index is not None, "Retrieval needs an index, e.g. MemoryManager(context, index=MemoryIndex())"
+        ranked = [name for name, _ in self.index.search(query, k=k if max_tokens is None else 4 * k)]
+        if max_tokens is None:
+            return ranked
+        selected, used = [], 0
+        # Providers are only called for the candidates that are considered, k at a time
+        for start in range(0, len(ranked), k):
+            batch = ranked[start:start + k]
+            values = self.get_memories(*batch)
+            for name in batch:
+                tokens = count_tokens({'role': 'system', 'content': _memory_content(name, values[name]), 'name': 'load_memory'})
+                if used + tokens <= max_tokens:
+                    selected.append(name)
+                    used += tokens
+                    if len(selected) == k:
+                        return selected
+        return selected
+
+    def load_relevant_memories(self, k=5, max_tokens=None, recent=4):
+        """
+        Loads the k memories most relevant to the last `recent` user and assistant messages, within `max_tokens`, and
+        unloads the ones loaded earlier that aren't relevant anymore. Returns the names of the loaded memories.
+        """
+        names = self.retrieve(self._query(recent), k=k, max_tokens=max_tokens)
+        loaded = [slot[len('memory:'):] for slot in self.context.messages.slots if slot.startswith('memory:')]
+        stale = [name for name in loaded if name not in names]
+        if stale:
+            self.unload_memories(*stale)
+        if names:
+            self.load_memories(*names)
+        return names
+
+
+def _memory_content(name, value):
+    return f'[Loaded Memory "{name}"]: {value}'
 
 
 if __name__ == '__main__':
+    try:
+        from cassette import from_env
+    except ImportError: # completions/ isn't on the PYTHONPATH, so there's nothing to record or replay with
+        from_env = lambda backend: backend
+    backend = from_env(chatgpt) # set CASSETTE=session.jsonl to record the completions, and CASSETTE_MODE=replay to replay them
+
     context = Context()
     context.add_message('system', "You are regular citizen walking down the street.\nYou use your memory of citizens in your neighborhood to inform your actions.\nJohn has just approached your and you must respond.")
     context.add_message('user', "Hey 👋, it's John!")
@@ -46,12 +210,12 @@ if __name__ == '__main__':
     memory_manager.add_memory('who is john', 'John murdered your family.')
     
     with context.branch():
-        response = chatgpt.complete(context.messages, model='gpt-4', use_cache=True)
+        response = backend.complete(context.messages.to_dicts(), model='gpt-4', use_cache=True)
         print('Without memory loaded:\n')
         print(response)
 
     with context.branch():
         memory_manager.load_memories('who is john')
-        response = chatgpt.complete(context.messages, model='gpt-4', use_cache=True)
+        response = backend.complete(context.messages.to_dicts(), model='gpt-4', use_cache=True)
         print('\nWith memory loaded:\n')
         print(response)
@@ -0,0 +1,246 @@
+import re
+import threading
+import zlib
+
+import numpy as np
+
+_WORDS = re.compile(r'\w+')
+
+
+def _bucket_type(dim):
+    # 16 bit buckets take less memory and sort in linear time
+    return np.uint16 if dim <= 1 << 16 else np.int32
+
+
+class HashingEmbedder:
+    """
+    Embeds texts locally by hashing their words, pairs of words and the character n-grams of the words into `dim`
+    buckets, so no model or network is needed. Stop words are left out, so filler like "tell me about" doesn't decide
+    the ranking, and the n-grams still match word pieces like plurals. The vectors are sparse: `features()` returns
+    only their nonzero buckets, which is what MemoryIndex stores.
+    Any callable that takes a list of texts and returns an array of L2-normalized row vectors can be used instead.
+    """
+    STOP_WORDS = frozenset(
+        'a about above after again all am an and any are as at be been before being below between both but by can could '
+        'did do does doing down during each few for from further had has have having he her here hers herself him '
+        'himself his how i if in into is it its itself just me more most my myself no nor not now of off on once only '
+        'or other our ours ourselves out over own same she should so some such than that the their theirs them '
+        'themselves then there these they this those through to too under until up very was we were what when where '
+        'which while who whom why will with would you your yours yourself yourselves'.split()
+    )
+
+    def __init__(self, dim=2**16, ngram=3, word_weight=2.0):
+        self.dim = dim
+        self.ngram = ngram
+        # Words and pairs of words count this many times as much as an n-gram
+        self.word_weight = word_weight
+
+    def features(self, text):
+        """Returns the nonzero buckets of the text's vector, sorted, and their weights."""
+        words = [word for word in _WORDS.findall(text.lower()) if word not in self.STOP_WORDS]
+        tokens = words + [f'{a} {b}' for a, b in zip(words, words[1:])]
+        hashes = [np.array([zlib.crc32(token.encode()) for token in tokens], dtype=np.uint32)]
+        data = np.frombuffer(f' {" ".join(words)} '.encode(), dtype=np.uint8).astype(np.uint32)
+        n = self.ngram
+        if len(data) >= n:
+            # FNV-1a over each window of n bytes, all windows at once
+            h = np.full(len(data) - n + 1, 2166136261, dtype=np.uint32)
+            for j in range(n):
+                h = (h ^ data[j:len(data) - n + 1 + j]) * np.uint32(16777619)
+            hashes.append(h)
+        weights = np.ones(sum(map(len, hashes)), dtype=np.float32)
+        weights[:len(tokens)] = self.word_weight
+        buckets, inverse = np.unique(np.concatenate(hashes) % self.dim, return_inverse=True)
+        weights = np.log1p(np.bincount(inverse, weights)).astype(np.float32)
+        return buckets.astype(_bucket_type(self.dim)), weights / max(np.linalg.norm(weights), 1e-12)
+
+    def __call__(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            buckets, weights = self.features(text)
+            vectors[i, buckets] = weights
+        return vectors
+
+
+class _DenseRows:
+    # The vectors are rows of one matrix, so a search is a single matrix-vector product. Removing moves the last row
+    # into the freed one.
+    def __init__(self):
+        self.vectors = None
+        self.names = []
+        self.rows = {}
+
+    def add(self, name, vector):
+        row = self.rows.get(name)
+        if row is None:
+            row = len(self.names)
+            if self.vectors is None:
+                self.vectors = np.empty((16, len(vector)), dtype=np.float32)
+            elif row == len(self.vectors):
+                self.vectors = np.concatenate([self.vectors, np.empty_like(self.vectors)])
+            self.names.append(name)
+            self.rows[name] = row
+        self.vectors[row] = vector
+
+    def remove(self, name):
+        row = self.rows.pop(name, None)
+        if row is None:
+            return
+        last = len(self.names) - 1
+        if row != last:
+            self.vectors[row] = self.vectors[last]
+            self.names[row] = self.names[last]
+            self.rows[self.names[row]] = row
+        self.names.pop()
+
+    def scores(self, query):
+        return self.vectors[:len(self.names)] @ query
+
+
+class _SparseRows:
+    # The vectors are postings grouped by bucket, so a search only reads the buckets of the query. Added rows are
+    # appended to a tail that's scanned whole, and removed rows are masked, until they're merged into the postings once
+    # they make up a fraction of them. Rows are renumbered when more than half of them were removed.
+    def __init__(self, dim):
+        self.dim = dim
+        self.names = []
+        self.rows = {}
+        self._buckets = []
+        self._alive = np.zeros(16, dtype=bool)
+        # How many memories have each bucket, for the IDF weights
+        self.df = np.zeros(dim, dtype=np.int64)
+        self._offsets = np.zeros(dim + 1, dtype=np.int64)
+        self._rows = np.empty(0, dtype=np.int32)
+        self._weights = np.empty(0, dtype=np.float32)
+        self._tail = (np.empty(1024, dtype=_bucket_type(dim)), np.empty(1024, dtype=np.int32), np.empty(1024, dtype=np.float32))
+        self._tail_size = 0
+        self._removed = []
+        self._pending = 0
+
+    def add(self, name, vector):
+        self.remove(name)
+        buckets, weights = vector
+        row = self.rows[name] = len(self.names)
+        self.names.append(name)
+        self._buckets.append(buckets)
+        if row == len(self._alive):
+            self._alive = np.concatenate([self._alive, np.zeros_like(self._alive)])
+        self._alive[row] = True
+        self.df[buckets] += 1
+        start, stop = self._tail_size, self._tail_size + len(buckets)
+        if stop > len(self._tail[0]):
+            self._tail = tuple(np.concatenate([array, np.empty(max(stop, 2 * len(array)), dtype=array.dtype)]) for array in self._tail)
+        for array, values in zip(self._tail, (buckets, row, weights)):
+            array[start:stop] = values
+        self._tail_size = stop
+        self._changed(len(buckets))
+
+    def remove(self, name):
+        row = self.rows.pop(name, None)
+        if row is None:
+            return
+        buckets = self._buckets[row]
+        self.df[buckets] -= 1
+        self.names[row] = self._buckets[row] = None
+        self._alive[row] = False
+        self._removed.append(row)
+        self._changed(len(buckets))
+
+    def _changed(self, entries):
+        self._pending += entries
+        if self._pending > max(1 << 16, len(self._rows) // 16):
+            self._merge()
+
+    def _merge(self):
+        tail_buckets, tail_rows, tail_weights = (array[:self._tail_size] for array in self._tail)
+        counts = np.diff(self._offsets)
+        if self._removed:
+            keep = self._alive[self._rows]
+            counts = np.bincount(np.repeat(np.arange(self.dim), counts)[keep], minlength=self.dim)
+            self._rows, self._weights = self._rows[keep], self._weights[keep]
+            keep = self._alive[tail_rows]
+            tail_buckets, tail_rows, tail_weights = tail_buckets[keep], tail_rows[keep], tail_weights[keep]
+        order = np.argsort(tail_buckets, kind='stable')
+        tail_buckets = tail_buckets[order]
+        # The tail's postings go after the ones of their bucket, without sorting the postings again
+        ends = np.cumsum(counts)[tail_buckets]
+        self._rows = np.insert(self._rows, ends, tail_rows[order])
+        self._weights = np.insert(self._weights, ends, tail_weights[order])
+        self._offsets[1:] = np.cumsum(counts + np.bincount(tail_buckets, minlength=self.dim))
+        self._tail_size = 0
+        self._removed = []
+        self._pending = 0
+        if 2 * len(self.rows) < len(self.names):
+            renumbered = np.cumsum(self._alive) - 1
+            self._rows = renumbered[self._rows].astype(np.int32)
+            self.names = [name for name in self.names if name is not None]
+            self._buckets = [buckets for buckets in self._buckets if buckets is not None]
+            self.rows = {name: row for row, name in enumerate(self.names)}
+            self._alive[:] = False
+            self._alive[:len(self.names)] = True
+
+    def scores(self, query):
+        buckets, weights = query
+        n = len(self.names)
+        # Buckets that few memories have say more about relevance than ones that most memories share
+        weights = weights * (np.log((len(self.rows) + 1) / (self.df[buckets] + 1)) + 1)
+        weights /= max(np.linalg.norm(weights), 1e-12)
+        starts, stops = self._offsets[buckets], self._offsets[buckets + 1]
+        sizes = stops - starts
+        index = np.repeat(stops - np.cumsum(sizes), sizes) + np.arange(sizes.sum())
+        scores = np.zeros(n)
+        scores += np.bincount(self._rows[index], self._weights[index] * np.repeat(weights, sizes), minlength=n)
+        tail_buckets, tail_rows, tail_weights = (array[:self._tail_size] for array in self._tail)
+        query = np.zeros(self.dim, dtype=bool)
+        query[buckets] = True
+        hits = np.flatnonzero(query[tail_buckets])
+        tail_buckets = tail_buckets[hits]
+        scores += np.bincount(tail_rows[hits], weights[np.searchsorted(buckets, tail_buckets)] * tail_weights[hits], minlength=n)
+        # Removed rows stay in the postings until the merge
+        scores[self._removed] = 0
+        return scores
+
+
+class MemoryIndex:
+    """
+    A similarity index over named texts, searched with vectorized NumPy operations, so it stays fast with hundreds of
+    thousands of entries. Entries are added, replaced and removed one at a time.
+    An embedder with a `features(text)` method that returns sparse vectors, like HashingEmbedder, is stored sparse, and
+    its buckets are weighted by their inverse document frequency. Any other embedder's vectors are rows of one matrix.
+    """
+    def __init__(self, embedder=None):
+        self.embedder = embedder or HashingEmbedder()
+        self._sparse = hasattr(self.embedder, 'features')
+        self._store = _SparseRows(self.embedder.dim) if self._sparse else _DenseRows()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._store.rows)
+
+    def __contains__(self, name):
+        return name in self._store.rows
+
+    def _embed(self, text):
+        return self.embedder.features(text) if self._sparse else self.embedder([text])[0]
+
+    def add(self, name, text):
+        vector = self._embed(text)
+        with self._lock:
+            self._store.add(name, vector)
+
+    def remove(self, name):
+        with self._lock:
+            self._store.remove(name)
+
+    def search(self, text, k=10):
+        """Returns up to k (name, score) pairs with the highest similarity to the text, best first."""
+        query = self._embed(text)
+        with self._lock:
+            if not self._store.rows or k <= 0:
+                return []
+            scores = self._store.scores(query)
+            names = self._store.names
+            n = len(scores)
+            top = np.argpartition(-scores, k - 1)[:k] if k < n else np.arange(n)
+            top = top[np.argsort(-scores[top], kind='stable')]
+            return [(names[i], float(scores[i])) for i in top if scores[i] > 0]
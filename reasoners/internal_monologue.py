@@ -1,42 +1,399 @@
+import asyncio
+import copy
+import functools
+import inspect
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
 import chatgpt
+try:
+    from context_management import Context, count_tokens
+except ImportError:
+    # Not on the PYTHONPATH (or shadowed by the folder of the same name when run from the repo root), so load it from
+    # the sibling folder by file and the examples run on their own. sys.path is left alone.
+    import importlib.util, os, sys
+    _spec = importlib.util.spec_from_file_location('context_management', os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '..', 'context_management', 'context_management.py'))
+    sys.modules['context_management'] = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(sys.modules['context_management'])
+    from context_management import Context, count_tokens
+
+
+class PrefixStripper:
+    """Removes every occurrence of `prefix` from streamed text, even when it's split across chunks."""
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.pending = ''
+
+    def feed(self, chunk):
+        text = (self.pending + chunk).replace(self.prefix, '')
+        # Hold back the end of the text if it could be the start of the prefix
+        keep = next((k for k in range(min(len(self.prefix) - 1, len(text)), 0, -1) if self.prefix.startswith(text[-k:])), 0)
+        self.pending = text[len(text) - keep:]
+        return text[:len(text) - keep]
+
+    def flush(self):
+        text, self.pending = self.pending, ''
+        return text
+
+
+class CompletionCache:
+    """
+    An in-memory LRU cache of completions. The keys use the digest of the messages, so a lookup costs the same however
+    long the conversation is, while the backend's own cache has to serialize every message to build its key.
+    Function calls are copied in and out, so callers can modify what they get.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns a 1-tuple with the cached completion, or None on a miss."""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            value = self._entries[key]
+        return (_copy_completion(value),)
+
+    def set(self, key, value):
+        value = _copy_completion(value)
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _copy_completion(value):
+    return value if isinstance(value, str) else copy.deepcopy(value)
+
+
+_NO_SPAN = nullcontext()
+
+
+def traced(method):
+    """Runs the method in a span named after it when the reasoner has a tracer. Works for async methods and generators too."""
+    name = method.__name__
+    if inspect.isasyncgenfunction(method):
+        def traced_method(self, *args, **kwargs):
+            if self.tracer is None:
+                return method(self, *args, **kwargs)
+            return self.tracer.span(name).aiterate(method(self, *args, **kwargs))
+    elif inspect.isgeneratorfunction(method):
+        def traced_method(self, *args, **kwargs):
+            if self.tracer is None:
+                return method(self, *args, **kwargs)
+            return self.tracer.span(name).iterate(method(self, *args, **kwargs))
+    elif inspect.iscoroutinefunction(method):
+        async def traced_method(self, *args, **kwargs):
+            if self.tracer is None:
+                return await method(self, *args, **kwargs)
+            with self.tracer.span(name):
+                return await method(self, *args, **kwargs)
+    else:
+        def traced_method(self, *args, **kwargs):
+            if self.tracer is None:
+                return method(self, *args, **kwargs)
+            with self.tracer.span(name):
+                return method(self, *args, **kwargs)
+    return functools.wraps(method)(traced_method)
 
 
 class Reasoner:
-    def __init__(self, system_prompt=None, model='gpt-4'):
+    def __init__(self, system_prompt=None, model='gpt-4', eviction=None, use_cache=False, backend=chatgpt, tracer=None,
+                 compaction=None, compact_in_background=False, completion_cache=None):
         self.model = model
-        self.messages = []
+        self.use_cache = use_cache
+        # Used for completions requested with use_cache=True. Forks share it, and reasoners can be given the same one.
+        self.completion_cache = completion_cache if completion_cache is not None else CompletionCache()
+        # Anything with chatgpt's complete() signature works as a backend, see completions/ for a local stand-in.
+        # Backends can define an async acomplete() as well, otherwise async calls run complete() in a thread.
+        # Backends that support streaming define stream() and/or astream(), which yield chunks of text, otherwise
+        # complete() is called with stream=True.
+        self.backend = backend
+        # Overrides the scheduling priority of every completion when set, e.g. 'background' for speculative forks
+        self.priority = None
+        # An optional Tracer (see tracing/) records a span for every step and completion
+        self.tracer = tracer
+        # An optional EvictionPolicy keeps the messages within the model's context window
+        self.context = Context(eviction=eviction, tracer=tracer)
+        # An optional MonologueCompaction drops or summarizes old internal monologue segments. In the background, the
+        # compaction is planned in a worker thread and applied before the first completion after it's done.
+        self.compaction = compaction
+        self.compact_in_background = compact_in_background
+        self._compaction_executor = None
+        self._compaction_future = None
         if system_prompt:
-            self.messages.append({'role': 'system', 'content': system_prompt})
+            self.add_message('system', system_prompt)
         self._is_internal = False
+        # Set when a monologue segment ended, it's compacted once the response it led to is in
+        self._segment_closed = False
+
+    @property
+    def messages(self):
+        return self.context.messages
 
     def add_message(self, role, message, name=None):
-        msg = {'role': role, 'content': message}
-        if name:
-            msg['name'] = name
-        self.messages.append(msg)
+        self.context.add_message(role, message, name)
 
-    def external_dialogue(self, thought):
+    def fork(self):
+        """Returns a copy of this reasoner on a fork of its context. The fork can be used concurrently with this reasoner."""
+        reasoner = copy.copy(self)
+        reasoner.context = self.context.fork()
+        reasoner._compaction_executor = reasoner._compaction_future = None
+        return reasoner
+
+    def _commit(self, fork):
+        # Continues from where a fork of this reasoner is. Committing forks turn after turn would share the storage of
+        # every earlier turn, so the messages are copied once they get deep, before the next forks branch from them.
+        messages = self.context.messages = fork.context.messages
+        if messages.depth >= messages.MAX_DEPTH - 1:
+            messages.flatten()
+        self._is_internal = fork._is_internal
+
+    def compact(self, wait=False):
+        """Compacts the old monologue segments. Runs in the background if compact_in_background is set, unless wait=True."""
+        if self.compaction is None:
+            return
+        if self.compact_in_background and not wait:
+            if self._compaction_future is None:
+                if self._compaction_executor is None:
+                    self._compaction_executor = ThreadPoolExecutor(max_workers=1)
+                self._compaction_future = self._compaction_executor.submit(self.compaction.plan, list(self.messages))
+            return
+        self._apply_compaction(wait=True)
+        self.compaction.compact(self.messages)
+
+    def _apply_compaction(self, wait=False):
+        future = self._compaction_future
+        if future is None or not (wait or future.done()):
+            return
+        self._compaction_future = None
+        self.compaction.apply(self.messages, future.result())
+
+    def _prepare(self):
+        # Runs before every completion
+        if self.compaction is not None:
+            self._apply_compaction()
+            if self.compaction.max_tokens is not None and self.context.tokens > self.compaction.max_tokens:
+                self.compact()
+        self.context.fit()
+
+    def _backend_kwargs(self, kwargs):
+        # A scheduler (see completions/scheduler.py) serves the external dialogue before the monologue
+        if getattr(self.backend, 'accepts_priority', False):
+            return {**kwargs, 'priority': self.priority or ('monologue' if self._is_internal else 'external')}
+        return kwargs
+
+    def _cache_key(self, model, kwargs):
+        if not kwargs.get('use_cache'):
+            return None
+        # The backend is part of the key, so a hit can't skip a different backend, e.g. a recording cassette or a scheduler
+        return (self.backend, self.context.digest, model, json.dumps(kwargs, sort_keys=True, default=str))
+
+    def _completion_span(self, kwargs, stream=False, model=None):
+        if self.tracer is None:
+            return _NO_SPAN
+        function_call = kwargs.get('function_call')
+        return self.tracer.span(
+            'complete', model=model or self.model, messages=len(self.messages), prompt_tokens=self.context.tokens,
+            function=function_call and function_call['name'], stream=stream,
+        )
+
+    def _trace_completion(self, span, key, cached, response):
+        if key:
+            span.set(cache='hit' if cached else 'miss')
+        text = response if isinstance(response, str) else json.dumps(response.get('args'))
+        span.set(completion_tokens=count_tokens({'content': text}))
+
+    def _complete(self, model=None, **kwargs):
+        # model overrides self.model for this completion
+        model = model or self.model
+        self._prepare()
+        with self._completion_span(kwargs, model=model) as span:
+            key = self._cache_key(model, kwargs)
+            cached = key and self.completion_cache.get(key)
+            if cached:
+                response = cached[0]
+            else:
+                response = self.backend.complete(messages=self.messages.to_dicts(), model=model, **self._backend_kwargs(kwargs))
+                if key:
+                    self.completion_cache.set(key, response)
+            if span:
+                self._trace_completion(span, key, cached, response)
+            return response
+
+    async def _acomplete(self, model=None, **kwargs):
+        model = model or self.model
+        self._prepare()
+        with self._completion_span(kwargs, model=model) as span:
+            key = self._cache_key(model, kwargs)
+            cached = key and self.completion_cache.get(key)
+            if cached:
+                response = cached[0]
+            else:
+                if hasattr(self.backend, 'acomplete'):
+                    response = await self.backend.acomplete(messages=self.messages.to_dicts(), model=model, **self._backend_kwargs(kwargs))
+                else:
+                    response = await asyncio.to_thread(self.backend.complete, messages=self.messages.to_dicts(), model=model, **self._backend_kwargs(kwargs))
+                if key:
+                    self.completion_cache.set(key, response)
+            if span:
+                self._trace_completion(span, key, cached, response)
+            return response
+
+    def _stream(self, **kwargs):
+        self._prepare()
+        with self._completion_span(kwargs, stream=True):
+            if hasattr(self.backend, 'stream'):
+                yield from self.backend.stream(messages=self.messages.to_dicts(), model=self.model, **self._backend_kwargs(kwargs))
+                return
+            # chatgpt.complete(stream=True) returns a generator of chunks, backends that can't stream return the text
+            response = self.backend.complete(messages=self.messages.to_dicts(), model=self.model, stream=True, **self._backend_kwargs(kwargs))
+            if isinstance(response, str):
+                yield response
+            else:
+                yield from response
+
+    async def _astream(self, **kwargs):
+        if not hasattr(self.backend, 'astream'):
+            yield await self._acomplete(**kwargs)
+            return
+        self._prepare()
+        with self._completion_span(kwargs, stream=True):
+            async for chunk in self.backend.astream(messages=self.messages.to_dicts(), model=self.model, **self._backend_kwargs(kwargs)):
+                yield chunk
+
+    def _start_external_dialogue(self, thought):
         # thought should describe how to respond, e.g. "I should respond to the user with the joke I came up with."
         self.add_message('assistant', '[Internal Monologue]: ' + thought)
         if self._is_internal:
             self._is_internal = False
             self.add_message('assistant', '[Internal Monologue]: I am now entering the external dialogue state. Everything I say there will be seen.')
             self.add_message('function', '[Exited Internal Monologue]', 'exit_monologue')
-        response = chatgpt.complete(messages=self.messages, model=self.model)
+            self._segment_closed = True
+
+    def _finish_external_dialogue(self, response):
         self.add_message('assistant', response)
+        if self._segment_closed:
+            self._segment_closed = False
+            if self.compaction is not None:
+                self.compact()
         return response
 
-    def internal_monologue(self, thought):
+    @traced
+    def external_dialogue(self, thought):
+        self._start_external_dialogue(thought)
+        return self._finish_external_dialogue(self._complete())
+
+    @traced
+    async def aexternal_dialogue(self, thought):
+        self._start_external_dialogue(thought)
+        return self._finish_external_dialogue(await self._acomplete())
+
+    @traced
+    def stream_external_dialogue(self, thought):
+        """
+        Like external_dialogue(), but yields the response in chunks as they arrive.
+        The response is added to the messages once, when the stream finishes or is closed early.
+        """
+        self._start_external_dialogue(thought)
+        chunks = []
+        try:
+            for chunk in self._stream():
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            if chunks:
+                self._finish_external_dialogue(''.join(chunks))
+
+    @traced
+    async def astream_external_dialogue(self, thought):
+        """Async version of stream_external_dialogue(). The partial response is kept if the task is cancelled."""
+        self._start_external_dialogue(thought)
+        chunks = []
+        try:
+            async for chunk in self._astream():
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            if chunks:
+                self._finish_external_dialogue(''.join(chunks))
+
+    def _start_internal_monologue(self, thought):
         if not self._is_internal:
             self._is_internal = True
             self.add_message('function', '[Entered Internal Monologue]', 'enter_monologue')
             self.add_message('assistant', "[Internal Monologue]: I am now in the internal monologue state. I won't be able to respond here, so I'll use this space to think, reflect, and plan.")
         self.add_message('assistant', '[Internal Monologue]: ' + thought)
-        response = chatgpt.complete(messages=self.messages, model=self.model)
+
+    def _finish_internal_monologue(self, response):
         response = response.replace('[Internal Monologue]: ', '')
         self.add_message('assistant', '[Internal Monologue]: ' + response)
         return response
-    
+
+    @traced
+    def internal_monologue(self, thought):
+        self._start_internal_monologue(thought)
+        return self._finish_internal_monologue(self._complete(use_cache=self.use_cache))
+
+    @traced
+    async def ainternal_monologue(self, thought):
+        self._start_internal_monologue(thought)
+        return self._finish_internal_monologue(await self._acomplete(use_cache=self.use_cache))
+
+    @traced
+    def stream_internal_monologue(self, thought):
+        """Like internal_monologue(), but yields the thought in chunks, with the monologue prefix removed as it streams."""
+        self._start_internal_monologue(thought)
+        stripper = PrefixStripper('[Internal Monologue]: ')
+        chunks = []
+        try:
+            for chunk in self._stream(use_cache=self.use_cache):
+                chunk = stripper.feed(chunk)
+                if chunk:
+                    chunks.append(chunk)
+                    yield chunk
+            chunk = stripper.flush()
+            if chunk:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            chunks.append(stripper.flush())
+            if any(chunks):
+                self._finish_internal_monologue(''.join(chunks))
+
+    @traced
+    async def astream_internal_monologue(self, thought):
+        """Async version of stream_internal_monologue()."""
+        self._start_internal_monologue(thought)
+        stripper = PrefixStripper('[Internal Monologue]: ')
+        chunks = []
+        try:
+            async for chunk in self._astream(use_cache=self.use_cache):
+                chunk = stripper.feed(chunk)
+                if chunk:
+                    chunks.append(chunk)
+                    yield chunk
+            chunk = stripper.flush()
+            if chunk:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            chunks.append(stripper.flush())
+            if any(chunks):
+                self._finish_internal_monologue(''.join(chunks))
+
+
 from colorama import Fore, Style
 def printc(*args, color='reset', **kwargs):
     color_code = getattr(Fore, color.upper(), Fore.RESET)
@@ -45,11 +402,16 @@ def printc(*args, color='reset', **kwargs):
 
 
 if __name__ == '__main__':
+    try:
+        from cassette import from_env
+    except ImportError: # completions/ isn't on the PYTHONPATH, so there's nothing to record or replay with
+        from_env = lambda backend: backend
     system_prompt = (
         "You use your internal monologue to reason before responding to the user. "
         "You try to maximize how funny your response is."
     )
-    reasoner = Reasoner(system_prompt=system_prompt, model='gpt-4')
+    # Set CASSETTE=session.jsonl to record the completions, and CASSETTE_MODE=replay to replay them
+    reasoner = Reasoner(system_prompt=system_prompt, model='gpt-4', backend=from_env(chatgpt))
 
     while True:
         message = input("\nUser: ")
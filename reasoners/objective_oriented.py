@@ -1,96 +1,174 @@
-import chatgpt
-
-
-class Reasoner:
-    def __init__(self, system_prompt=None, model='gpt-4'):
-        self.model = model
-        self.messages = []
-        if system_prompt:
-            self.messages.append({'role': 'system', 'content': system_prompt})
-        self._is_internal = False
-
-    def add_message(self, role, message, name=None):
-        msg = {'role': role, 'content': message}
-        if name:
-            msg['name'] = name
-        self.messages.append(msg)
-
-    def external_dialogue(self, thought):
-        # thought should describe how to respond, e.g. "I should respond to the user with the joke I came up with."
-        self.add_message('assistant', '[Internal Monologue]: ' + thought)
-        if self._is_internal:
-            self._is_internal = False
-            self.add_message('assistant', '[Internal Monologue]: I am now entering the external dialogue state. Everything I say there will be seen.')
-            self.add_message('function', '[Exited Internal Monologue]', 'exit_monologue')
-        response = chatgpt.complete(messages=self.messages, model=self.model)
-        self.add_message('assistant', response)
-        return response
-
-    def internal_monologue(self, thought):
-        if not self._is_internal:
-            self._is_internal = True
-            self.add_message('function', '[Entered Internal Monologue]', 'enter_monologue')
-            self.add_message('assistant', "[Internal Monologue]: I am now in the internal monologue state. I won't be able to respond here, so I'll use this space to think, reflect, and plan.")
-        self.add_message('assistant', '[Internal Monologue]: ' + thought)
-        response = chatgpt.complete(messages=self.messages, model=self.model)
-        response = response.replace('[Internal Monologue]: ', '')
-        self.add_message('assistant', '[Internal Monologue]: ' + response)
-        return response
+import re
+from collections import Counter
+
+from internal_monologue import Reasoner, printc, traced
+
+
+OBJECTIVE_STATUS_KWARGS = dict(
+    functions=[{
+        "name": "set_objective_status",
+        "description": "Sets the status of the objective by setting the objective_complete flag to True or False.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "objective_complete": {
+                    "description": "The status of the objective. True for complete, False for incomplete.",
+                    "type": "boolean",
+                }
+            },
+            "required": ["objective_complete"]
+        }
+    }],
+    function_call={'name': 'set_objective_status'}
+)
+
+# Used with the triage model, which can say it's unsure
+TRIAGE_STATUS_KWARGS = dict(
+    functions=[{
+        "name": "set_objective_status",
+        "description": "Sets the status of the objective. Use unsure if the conversation doesn't clearly show whether the objective is complete.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "objective_status": {
+                    "description": "The status of the objective.",
+                    "type": "string",
+                    "enum": ["complete", "incomplete", "unsure"],
+                }
+            },
+            "required": ["objective_status"]
+        }
+    }],
+    function_call={'name': 'set_objective_status'}
+)
+
+
+def regex_check(*patterns, role='user', otherwise=None):
+    """
+    A local objective check, which is True when a new message from `role` matches one of the patterns (ignoring case),
+    and `otherwise` when none does. Leave otherwise=None when a miss doesn't mean the objective is incomplete.
+    """
+    regex = re.compile('|'.join(f'(?:{pattern})' for pattern in patterns), re.IGNORECASE)
+
+    def check(messages):
+        if any(message['role'] == role and regex.search(message['content']) for message in messages):
+            return True
+        return otherwise
+    return check
+
+
+# Holds the last message the previous verdict saw
+SEEN_SLOT = 'objective:seen'
 
 
 class ObjectiveReasoner(Reasoner):
-    def __init__(self, objective=None, system_prompt=None, model='gpt-4'):
-        super().__init__(system_prompt=system_prompt, model=model)
+    """
+    Evaluating the objective goes through cheaper tiers first:
+    - skipped: nothing was said by the user or the assistant (outside the monologue) since the last verdict
+    - local: a check in `checks` settles it. A check takes the new user and assistant messages, and returns True or
+      False, or None when it can't tell (see regex_check).
+    - triage: `triage_model`, if set, is asked first and can answer unsure
+    - model: the reasoner's model decides
+    `evaluations` counts how many evaluations each tier settled.
+    """
+    def __init__(self, objective=None, system_prompt=None, model='gpt-4', checks=(), triage_model=None, **kwargs):
+        self.objective = None
+        super().__init__(system_prompt=system_prompt, model=model, **kwargs)
+        self.checks = list(checks)
+        self.triage_model = triage_model
+        self.evaluations = Counter()
         if objective is not None:
             self.set_objective(objective)
         self.objective_complete = False
 
     def set_objective(self, objective):
         self.objective = objective
+        self.messages.set_slot(SEEN_SLOT, None)
         objective_prompt = f'Your current objective is to: {objective}'
         if self.messages and self.messages[0]['role'] == 'system':
-            self.messages[0]['content'] = objective_prompt + self.messages[0]['content']
+            self.messages[0] = self.messages[0].replace(content=objective_prompt + self.messages[0]['content'])
         else:
             self.messages.insert(0, {'role': 'system', 'content': objective_prompt})
 
-    def evaluate_objective(self):
+    def _new_messages(self):
+        # The user and assistant messages after the last one the previous verdict saw, oldest first. That message is
+        # kept in a slot, so it's still found after messages before it are evicted or compacted (and it's pinned).
+        messages = self.messages
+        seen = messages.slot(SEEN_SLOT)
+        new = []
+        for i in range(0 if seen is None else seen + 1, len(messages)):
+            message = messages[i]
+            if message['role'] == 'user' or message['role'] == 'assistant' and not message['content'].startswith('[Internal Monologue]: '):
+                new.append(message)
+        return new
+
+    def _start_evaluation(self):
+        # Returns the new messages, and the tier and verdict if a cheap tier settles it
         assert self.objective is not None, "Can't evaluate objective, no objective set. Use set_objective() to set an objective before calling evaluate_objective()."
-        json_schema = {
-            "name": "set_objective_status",
-            "description": "Sets the status of the objective by setting the objective_complete flag to True or False.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "objective_complete": {
-                        "description": "The status of the objective. True for complete, False for incomplete.",
-                        "type": "boolean",
-                    }
-                },
-                "required": ["objective_complete"]
-            }
-        }
-        response = chatgpt.complete(messages=self.messages, model=self.model, functions=[json_schema], function_call={'name': 'set_objective_status'})
+        new = self._new_messages()
+        if not new:
+            return new, 'skipped', self.objective_complete
+        for check in self.checks:
+            verdict = check(new)
+            if verdict is not None:
+                return new, 'local', verdict
+        return new, None, None
+
+    def _triage_verdict(self, response):
+        status = response['args'].get('objective_status') if response['role'] == 'function' else None
+        return {'complete': True, 'incomplete': False}.get(status)
+
+    def _model_verdict(self, response):
         if response['role'] != 'function':
             raise Exception(f"Expected a function call, but got: {response['content']}")
-        self.objective_complete = response['args']['objective_complete']
-        self.add_message(response['role'], f'Set flag: OBJECTIVE_COMPLETE={str(self.objective_complete).upper()}', name=response['name'])
-
-
-from colorama import Fore, Style
-def printc(*args, color='reset', **kwargs):
-    color_code = getattr(Fore, color.upper(), Fore.RESET)
-    text = ' '.join(str(arg) for arg in args)
-    print(color_code + text + Style.RESET_ALL, **kwargs)
+        return response['args']['objective_complete']
+
+    def _set_objective_status(self, new, tier, verdict):
+        self.evaluations[tier] += 1
+        if tier == 'skipped':
+            return
+        self.objective_complete = verdict
+        messages = self.messages
+        i = len(messages) - 1
+        while messages[i] is not new[-1]:
+            i -= 1
+        messages.set_slot(SEEN_SLOT, i)
+        self.add_message('function', f'Set flag: OBJECTIVE_COMPLETE={str(verdict).upper()}', name='set_objective_status')
+
+    @traced
+    def evaluate_objective(self):
+        new, tier, verdict = self._start_evaluation()
+        if verdict is None and self.triage_model is not None:
+            tier, verdict = 'triage', self._triage_verdict(self._complete(model=self.triage_model, **TRIAGE_STATUS_KWARGS))
+        if verdict is None:
+            tier, verdict = 'model', self._model_verdict(self._complete(**OBJECTIVE_STATUS_KWARGS))
+        self._set_objective_status(new, tier, verdict)
+
+    @traced
+    async def aevaluate_objective(self):
+        new, tier, verdict = self._start_evaluation()
+        if verdict is None and self.triage_model is not None:
+            tier, verdict = 'triage', self._triage_verdict(await self._acomplete(model=self.triage_model, **TRIAGE_STATUS_KWARGS))
+        if verdict is None:
+            tier, verdict = 'model', self._model_verdict(await self._acomplete(**OBJECTIVE_STATUS_KWARGS))
+        self._set_objective_status(new, tier, verdict)
 
 
 if __name__ == '__main__':
+    import chatgpt
+    try:
+        from cassette import from_env
+    except ImportError: # completions/ isn't on the PYTHONPATH, so there's nothing to record or replay with
+        from_env = lambda backend: backend
     REFLECT = True
     system_prompt = (
         "You use your internal monologue to reason before responding to the user. "
         "You try to maximize how funny your response is."
     )
     objective = "Make the user laugh. The objective is complete when the user expreses laughter using 'haha' or 'lol', or similar."
-    reasoner = ObjectiveReasoner(objective=objective, system_prompt=system_prompt, model='gpt-4')
+    checks = [regex_check(r'\b(?:a?ha){2,}h?\b', r'\blo+l\b', r'\blmf?ao\b', r'\brofl\b')]
+    reasoner = ObjectiveReasoner(objective=objective, system_prompt=system_prompt, model='gpt-4', checks=checks,
+                                 triage_model='gpt-3.5-turbo', backend=from_env(chatgpt))
 
     while True:
         message = input("\nUser: ")
@@ -1,116 +1,186 @@
-import chatgpt
-
-
-class Reasoner:
-    def __init__(self, system_prompt=None, model='gpt-4'):
-        self.model = model
-        self.messages = []
-        if system_prompt:
-            self.messages.append({'role': 'system', 'content': system_prompt})
-        self._is_internal = False
-
-    def add_message(self, role, message, name=None):
-        msg = {'role': role, 'content': message}
-        if name:
-            msg['name'] = name
-        self.messages.append(msg)
-
-    def external_dialogue(self, thought):
-        # thought should describe how to respond, e.g. "I should respond to the user with the joke I came up with."
-        self.add_message('assistant', '[Internal Monologue]: ' + thought)
-        if self._is_internal:
-            self._is_internal = False
-            self.add_message('assistant', '[Internal Monologue]: I am now entering the external dialogue state. Everything I say there will be seen.')
-            self.add_message('function', '[Exited Internal Monologue]', 'exit_monologue')
-        response = chatgpt.complete(messages=self.messages, model=self.model)
-        self.add_message('assistant', response)
-        return response
-
-    def internal_monologue(self, thought):
-        if not self._is_internal:
-            self._is_internal = True
-            self.add_message('function', '[Entered Internal Monologue]', 'enter_monologue')
-            self.add_message('assistant', "[Internal Monologue]: I am now in the internal monologue state. I won't be able to respond here, so I'll use this space to think, reflect, and plan.")
-        self.add_message('assistant', '[Internal Monologue]: ' + thought)
-        response = chatgpt.complete(messages=self.messages, model=self.model)
-        response = response.replace('[Internal Monologue]: ', '')
-        self.add_message('assistant', '[Internal Monologue]: ' + response)
-        return response
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from internal_monologue import Reasoner, printc, traced
+
+
+# The function call kwargs are built once and reused, instead of rebuilding the schemas on every call
+RESPONSE_OPTIONS_KWARGS = dict(
+    functions=[{
+        "name": "store_response_options",
+        "description": "Stores a list of possible response options in memory to choose from later. E.g. ['attempt to explain mathematically', 'explain using an analogy', 'list resources to learn more']",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "responses": {
+                    "description": "The list of possible response options. Each element should be a short summary, not a full response.",
+                    "type": "array",
+                    "items": {
+                        "type": "string"
+                    }
+                }
+            },
+            "required": ["responses"]
+        }
+    }],
+    function_call={'name': 'store_response_options'}
+)
 
 
-class StructuredReasoner(Reasoner):
-    def __init__(self, system_prompt=None, model='gpt-4'):
-        super().__init__(system_prompt=system_prompt, model=model)
-
-    def parse_response_options(self):
-        json_schema = {
-            "name": "store_response_options",
-            "description": "Stores a list of possible response options in memory to choose from later. E.g. ['attempt to explain mathematically', 'explain using an analogy', 'list resources to learn more']",
+@lru_cache(maxsize=64)
+def choose_kwargs(n_options):
+    return dict(
+        functions=[{
+            "name": "choose",
+            "description": "Chooses one of the options.",
             "parameters": {
                 "type": "object",
                 "properties": {
-                    "responses": {
-                        "description": "The list of possible response options. Each element should be a short summary, not a full response.",
-                        "type": "array",
-                        "items": {
-                            "type": "string"
-                        }
+                    "choice_index": {
+                        "description": f"The index of the option you chose. An integer from 1 to {n_options}",
+                        "type": "integer",
                     }
                 },
-                "required": ["responses"]
+                "required": ["choice_index"]
             }
-        }
-        response = chatgpt.complete(messages=self.messages, model=self.model, functions=[json_schema], function_call={'name': 'store_response_options'})
+        }],
+        function_call={'name': 'choose'}
+    )
+
+
+class StructuredReasoner(Reasoner):
+    def __init__(self, system_prompt=None, model='gpt-4', **kwargs):
+        super().__init__(system_prompt=system_prompt, model=model, **kwargs)
+
+    def _store_response_options(self, response):
         if response['role'] != 'function':
             raise Exception(f"Expected a function call, but got: {response['content']}")
         repsonse_options = response['args']['responses']
         self.add_message(response['role'], 'Stored response options:' + '\n'.join(repsonse_options), name=response['name'])
         return repsonse_options
-        
 
-    def choose(self, options):
+    @traced
+    def parse_response_options(self):
+        return self._store_response_options(self._complete(**RESPONSE_OPTIONS_KWARGS))
+
+    @traced
+    async def aparse_response_options(self):
+        return self._store_response_options(await self._acomplete(**RESPONSE_OPTIONS_KWARGS))
+
+    def _start_choose(self, options):
         self.add_message('assistant', 
             '[Internal Monologue]: I need to record my choice as one of the following, '
             'by calling the choose() function with the corresponding choice number:\n' + 
             "\n".join([f"{i+1}. {option}" for i, option in enumerate(options)])
         )
-        json_schema = {
-            "name": "choose",
-            "description": "Chooses one of the options.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "choice_index": {
-                        "description": f"The index of the option you chose. An integer from 1 to {len(options)}",
-                        "type": "integer",
-                    }
-                },
-                "required": ["options"]
-            }
-        }
-        response = chatgpt.complete(messages=self.messages, model=self.model, functions=[json_schema], function_call={'name': 'choose'})
+        return choose_kwargs(len(options))
+
+    def _finish_choose(self, options, response):
         if response['role'] != 'function':
             raise Exception(f"Expected a function call, but got: {response['content']}")
         self.messages.pop() # remove the message that prompted the user to choose
         choice = response['args']['choice_index'] - 1
-        self.add_message(response['role'], f'Chose option: {options}', name=response['name'])
+        self.add_message(response['role'], f'Chose option: {options[choice] if 0 <= choice < len(options) else choice + 1}', name=response['name'])
         return choice
 
-
-from colorama import Fore, Style
-def printc(*args, color='reset', **kwargs):
-    color_code = getattr(Fore, color.upper(), Fore.RESET)
-    text = ' '.join(str(arg) for arg in args)
-    print(color_code + text + Style.RESET_ALL, **kwargs)
+    @traced
+    def choose(self, options):
+        return self._finish_choose(options, self._complete(**self._start_choose(options)))
+
+    @traced
+    async def achoose(self, options):
+        return self._finish_choose(options, await self._acomplete(**self._start_choose(options)))
+
+    def _draft_fork(self):
+        # Drafts are speculative, so a scheduler serves the choice first
+        draft = self.fork()
+        draft.priority = 'background'
+        return draft
+
+    def _draft(self, option, thought):
+        draft = self._draft_fork()
+        draft.add_message('function', f'Chose option: {option}', name='choose')
+        return draft, draft.external_dialogue(thought)
+
+    async def _adraft(self, option, thought):
+        draft = self._draft_fork()
+        draft.add_message('function', f'Chose option: {option}', name='choose')
+        return draft, await draft.aexternal_dialogue(thought)
+
+    @traced
+    def choose_and_respond(self, options, thought="I'll respond to the user using the response I chose.", top_k=None):
+        """
+        Does the same as choose() followed by external_dialogue(thought), and returns (choice, response).
+        While choose() runs, the response to each of the first `top_k` options (all of them by default) is drafted on a
+        fork, and the draft of the chosen option is kept, so the response is ready as soon as the choice is made.
+        Every draft is a completion, so a smaller top_k costs less, but if the choice isn't one of the drafted options,
+        the response is only generated after it. top_k=0 doesn't speculate at all.
+        """
+        drafted = options if top_k is None else options[:top_k]
+        if not drafted:
+            choice = self.choose(options)
+            return choice, self.external_dialogue(thought)
+
+        chooser = self.fork()
+        executor = ThreadPoolExecutor(max_workers=len(drafted))
+        try:
+            drafts = [executor.submit(self._draft, option, thought) for option in drafted]
+            choice = chooser.choose(options)
+            if 0 <= choice < len(drafts):
+                try:
+                    draft, response = drafts[choice].result()
+                except Exception:
+                    pass
+                else:
+                    self._commit(draft)
+                    return choice, response
+        finally:
+            # Drafts that haven't started are cancelled, running ones finish in the background and are ignored
+            executor.shutdown(wait=False, cancel_futures=True)
+        self._commit(chooser)
+        return choice, self.external_dialogue(thought)
+
+    @traced
+    async def achoose_and_respond(self, options, thought="I'll respond to the user using the response I chose.", top_k=None):
+        """Async version of choose_and_respond(). The drafts of the options that weren't chosen are cancelled."""
+        drafted = options if top_k is None else options[:top_k]
+        if not drafted:
+            choice = await self.achoose(options)
+            return choice, await self.aexternal_dialogue(thought)
+
+        chooser = self.fork()
+        drafts = [asyncio.ensure_future(self._adraft(option, thought)) for option in drafted]
+        try:
+            choice = await chooser.achoose(options)
+            if 0 <= choice < len(drafts):
+                try:
+                    draft, response = await drafts[choice]
+                except Exception:
+                    pass
+                else:
+                    self._commit(draft)
+                    return choice, response
+        finally:
+            for task in drafts:
+                task.cancel()
+            await asyncio.gather(*drafts, return_exceptions=True)
+        self._commit(chooser)
+        return choice, await self.aexternal_dialogue(thought)
 
 
 if __name__ == '__main__':
+    import chatgpt
+    try:
+        from cassette import from_env
+    except ImportError: # completions/ isn't on the PYTHONPATH, so there's nothing to record or replay with
+        from_env = lambda backend: backend
     THINK_FIRST = True
     system_prompt = (
         "You use your internal monologue to reason before responding to the user. "
         "You try to maximize how funny your response is."
     )
-    reasoner = StructuredReasoner(system_prompt=system_prompt, model='gpt-4')
+    reasoner = StructuredReasoner(system_prompt=system_prompt, model='gpt-4', backend=from_env(chatgpt))
 
     while True:
         message = input("\nUser: ")
@@ -132,8 +202,6 @@ if __name__ == '__main__':
             printc('\n' + thought, color='blue')
         else:
             reasoner.add_message('assistant', '[Internal Monologue]: I need to choose the funniest response')
-        choice = reasoner.choose(options)
+        choice, response = reasoner.choose_and_respond(options, "I'll respond to the user using the response I chose.")
         printc('\nChose response: ' + options[choice], color='yellow')
-
-        response = reasoner.external_dialogue(f"I'll respond to the user using the response I chose.")
         print('\n' + response)
@@ -1,52 +1,126 @@
+from functools import lru_cache
 from string import Formatter
 from typing import Union, Type
 from pydantic import BaseModel
 from pydantic.main import create_model
 
-import chatgpt
-
-class Reasoner:
-    def __init__(self, system_prompt=None, model='gpt-4'):
-        self.model = model
-        self.messages = []
-        if system_prompt:
-            self.messages.append({'role': 'system', 'content': system_prompt})
-        self._is_internal = False
-
-    def add_message(self, role, message, name=None):
-        msg = {'role': role, 'content': message}
-        if name:
-            msg['name'] = name
-        self.messages.append(msg)
-
-    def external_dialogue(self, thought):
-        # thought should describe how to respond, e.g. "I should respond to the user with the joke I came up with."
-        self.add_message('assistant', '[Internal Monologue]: ' + thought)
-        if self._is_internal:
-            self._is_internal = False
-            self.add_message('assistant', '[Internal Monologue]: I am now entering the external dialogue state. Everything I say there will be seen.')
-            self.add_message('function', '[Exited Internal Monologue]', 'exit_monologue')
-        response = chatgpt.complete(messages=self.messages, model=self.model)
-        self.add_message('assistant', response)
-        return response
-
-    def internal_monologue(self, thought):
-        if not self._is_internal:
-            self._is_internal = True
-            self.add_message('function', '[Entered Internal Monologue]', 'enter_monologue')
-            self.add_message('assistant', "[Internal Monologue]: I am now in the internal monologue state. I won't be able to respond here, so I'll use this space to think, reflect, and plan.")
-        self.add_message('assistant', '[Internal Monologue]: ' + thought)
-        response = chatgpt.complete(messages=self.messages, model=self.model, use_cache=True)
-        response = response.replace('[Internal Monologue]: ', '')
-        self.add_message('assistant', '[Internal Monologue]: ' + response)
-        return response
+from internal_monologue import Reasoner, printc, traced
+
+
+def is_pydantic(output_type):
+    return isinstance(output_type, type) and issubclass(output_type, BaseModel)
+
+
+class Extraction:
+    """
+    The function call used to extract one or more pieces of information, given as (info_format, output_type) specs.
+    All the format fields are combined into a single function, so they're extracted in one completion.
+    A spec with several format fields takes a {field_name: type} dict as its output_type.
+
+    Building the schema is slow, so use compile_extraction() to get a cached Extraction.
+    """
+    def __init__(self, specs):
+        assert len(specs) > 0, "At least one (info_format, output_type) spec is required."
+        self.specs = []
+        for info_format, output_type in specs:
+            field_names = [x[1] for x in Formatter().parse(info_format) if x[1] is not None]
+            assert len(field_names) > 0, f"No format field found in '{info_format}'."
+            if isinstance(output_type, dict):
+                assert set(output_type) == set(field_names), f"The output types {list(output_type)} don't match the fields of '{info_format}'."
+                field_types = {name: output_type[name] for name in field_names}
+            else:
+                assert len(field_names) == 1, f"'{info_format}' has more than one format field, pass a {{field_name: type}} dict as the output type."
+                field_types = {field_names[0]: output_type}
+            self.specs.append((info_format, field_types))
+
+        self.field_types = {}
+        for _, field_types in self.specs:
+            for name, field_type in field_types.items():
+                assert name not in self.field_types, f"The format field '{name}' is used more than once."
+                self.field_types[name] = field_type
+
+        # A single pydantic model is used as the function parameters directly, everything else is wrapped in a model
+        self.single_field = len(self.field_types) == 1
+        first_type = next(iter(self.field_types.values()))
+        self.use_pydantic = self.single_field and is_pydantic(first_type)
+        if self.use_pydantic:
+            self.model = first_type
+        else:
+            self.model = create_model("SingleFieldModel" if self.single_field else "ExtractedInfo", **{name: (t, ...) for name, t in self.field_types.items()})
+        params = self.model.model_json_schema()
+
+        func_name = "remember_" + "_and_".join(self.field_types)
+        if len(func_name) > 64:
+            func_name = "remember_info"
+        formats = ', '.join(f"'{info_format}'" for info_format, _ in self.specs)
+        self.json_schema = {
+            "name": func_name,
+            "description": f"This function stores a piece of information in the format: {formats}." if len(self.specs) == 1 else
+                           f"This function stores pieces of information in the formats: {formats}.",
+            "parameters": params
+        }
+        self.kwargs = dict(functions=[self.json_schema], function_call={'name': func_name}, use_cache=True)
+
+    def parse(self, args, validate=False):
+        """
+        Returns the extracted values as a {field_name: value} dict.
+        With validate=True the args are validated and converted to the field types using the pydantic model, which
+        raises a ValidationError if they don't match. Otherwise the values are used as is.
+        """
+        if validate:
+            validated = self.model.model_validate(args)
+            if self.use_pydantic:
+                return {next(iter(self.field_types)): validated}
+            return {name: getattr(validated, name) for name in self.field_types}
+        if self.use_pydantic:
+            field_name, field_type = next(iter(self.field_types.items()))
+            return {field_name: field_type.model_construct(**args)}
+
+        values = {}
+        for name, field_type in self.field_types.items():
+            if name in args:
+                value = args[name]
+            elif self.single_field:
+                # Generated JSON schema is sometimes incorrect, so we try to extract the field anyway
+                value = list(args.values())[-1]
+            else:
+                raise Exception(f"Expected the field '{name}' in the function call, but got: {args}")
+            values[name] = field_type.model_construct(**value) if is_pydantic(field_type) and isinstance(value, dict) else value
+        return values
+
+    def results(self, values):
+        """Returns the result for each spec: the value of its field, or a {field_name: value} dict if it has several fields."""
+        results = []
+        for _, field_types in self.specs:
+            spec_values = {name: values[name] for name in field_types}
+            results.append(next(iter(spec_values.values())) if len(spec_values) == 1 else spec_values)
+        return results
+
+    def infos(self, values):
+        return [info_format.format(**{name: values[name] for name in field_types}) for info_format, field_types in self.specs]
+
+
+def compile_extraction(specs):
+    """Returns the Extraction for a list of (info_format, output_type) specs, reusing a cached one when possible."""
+    key = tuple((info_format, tuple(output_type.items()) if isinstance(output_type, dict) else output_type) for info_format, output_type in specs)
+    try:
+        return _compile_extraction(key)
+    except TypeError: # unhashable output type
+        return Extraction(specs)
+
+
+@lru_cache(maxsize=1024)
+def _compile_extraction(key):
+    return Extraction([(info_format, dict(output_type) if isinstance(output_type, tuple) else output_type) for info_format, output_type in key])
 
 
 class StructuredReasoner(Reasoner):
-    def __init__(self, system_prompt=None, model='gpt-4'):
-        super().__init__(system_prompt, model)
+    def __init__(self, system_prompt=None, model='gpt-4', **kwargs):
+        kwargs.setdefault('use_cache', True)
+        super().__init__(system_prompt, model, **kwargs)
     
-    def extract_info(self, info_format, output_type: Union[BaseModel, Type]):
+    @traced
+    def extract_info(self, info_format, output_type: Union[BaseModel, Type], validate=False):
         """
         Extracts a piece of information in a specific format.
         This is done by using the function calling API to create a remember_{field_name} function and executing it.
@@ -54,17 +128,21 @@ class StructuredReasoner(Reasoner):
         This function is useful when you want to extract the outcome of an internal monologue in a specific format. 
         It doesn't work so well for reasoning, so stick to the paradigm of internal monologue -> extract_info.
         The format string is a python format string that determines the format of the stored information.
+        If it has several fields, they are all extracted in the same function call.
 
         Parameters:
         info_format (str):
             The format string that determines the format of the stored information. 
-        output_type (Union[BaseModel, Type]):
+        output_type (Union[BaseModel, Type, dict]):
             The type of the field to be extracted. 
             If a pydantic BaseModel is provided, the field is extracted as a pydantic model.
             If a python Type is provided, the field is extracted as an instance of that type.
+            If the format string has several fields, a {field_name: type} dict with the type of each field.
+        validate (bool):
+            Validate the extracted value against output_type and convert it, instead of returning the model's JSON as is.
 
         Returns:
-        The value of the field remembered by the reasoner
+        The value of the field remembered by the reasoner, or a {field_name: value} dict if there are several fields
 
         Examples:
         --------
@@ -88,54 +166,51 @@ class StructuredReasoner(Reasoner):
         >>> reasoner.add_message("user", "Add Ivan Yevenko (@ivan_yevenko) to the database, he's pretty based.")
         >>> reasoner.extract_info("Added {person} to the database.", Person)
         Person(name='Ivan Yevenko', twitter_handle='@ivan_yevenko', is_based=True)
+
+        Extracting several fields at once:
+        >>> reasoner.extract_info("I'll {plan} with {confidence} confidence.", {'plan': List[str], 'confidence': float})
+        {'plan': ['...', '...'], 'confidence': 0.8}
         """
-        formatter = Formatter()
-        parsed = [x for x in formatter.parse(info_format) if x[1] is not None]
-        assert len(parsed) == 1, "Only one format field is allowed."
+        return self.extract_infos([(info_format, output_type)], validate=validate)[0]
 
-        _, field_name, _, _ = parsed[0]
-        
-        use_pydantic = type(output_type) is type and issubclass(output_type, BaseModel)
-        if use_pydantic:
-            params = output_type.model_json_schema()
-        else:
-            SingleFieldModel = create_model("SingleFieldModel", **{field_name: (output_type, ...)})
-            params = SingleFieldModel.model_json_schema()
+    @traced
+    async def aextract_info(self, info_format, output_type: Union[BaseModel, Type], validate=False):
+        """Async version of extract_info()."""
+        return (await self.aextract_infos([(info_format, output_type)], validate=validate))[0]
 
-        func_name = "remember_" + field_name
-        json_schema = {
-            "name": func_name,
-            "description": f"This function stores a piece of information in the format: '{info_format}'.",
-            "parameters": params
-        }
+    @traced
+    def extract_infos(self, specs, validate=False):
+        """
+        Extracts several pieces of information in one function call, instead of calling extract_info() for each one.
+        `specs` is a list of (info_format, output_type) pairs, and the result of each is returned in a list, in the same order.
+
+        >>> plan, choice = reasoner.extract_infos([("My plan is: {plan}", List[str]), ("I chose option {choice}.", int)])
+        """
+        extraction = compile_extraction(specs)
+        return self._store_infos(extraction, self._complete(**extraction.kwargs), validate)
+
+    @traced
+    async def aextract_infos(self, specs, validate=False):
+        """Async version of extract_infos()."""
+        extraction = compile_extraction(specs)
+        return self._store_infos(extraction, await self._acomplete(**extraction.kwargs), validate)
 
-        response = chatgpt.complete(messages=self.messages, model=self.model, functions=[json_schema], function_call={'name': func_name}, use_cache=True)
+    def _store_infos(self, extraction, response, validate=False):
         if response['role'] != 'function':
             raise Exception(f"Expected a function call, but got: {response['content']}")
-        
-        value = response['args']
-        if use_pydantic:
-            value = output_type.model_construct(value)
-        else:
-            try:
-                value = value[field_name]
-            except KeyError:
-                # Generated JSON schema is sometimes incorrect, so we try to extract the field anyway
-                value = value.popitem()[1]
-
-        info = info_format.format(**{field_name: value})
-        self.add_message('function', f'Stored information: "{info}"', name=response['name'])
-        return value
-    
 
-from colorama import Fore, Style
-def printc(*args, color='reset', **kwargs):
-    color_code = getattr(Fore, color.upper(), Fore.RESET)
-    text = ' '.join(str(arg) for arg in args)
-    print(color_code + text + Style.RESET_ALL, **kwargs)
+        values = extraction.parse(response['args'], validate)
+        infos = '\n'.join(f'"{info}"' for info in extraction.infos(values))
+        self.add_message('function', f'Stored information: {infos}', name=response['name'])
+        return extraction.results(values)
 
 
 if __name__ == '__main__':
+    import chatgpt
+    try:
+        from cassette import from_env
+    except ImportError: # completions/ isn't on the PYTHONPATH, so there's nothing to record or replay with
+        from_env = lambda backend: backend
     from typing import List
 
     THINK_FIRST = False
@@ -143,7 +218,7 @@ if __name__ == '__main__':
         "You use your internal monologue to reason before responding to the user. "
         "You try to maximize how funny your response is."
     )
-    reasoner = StructuredReasoner(system_prompt=system_prompt, model='gpt-4')
+    reasoner = StructuredReasoner(system_prompt=system_prompt, model='gpt-4', backend=from_env(chatgpt))
 
     while True:
         message = input("\nUser: ")
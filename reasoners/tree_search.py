@@ -0,0 +1,291 @@
+import heapq
+import itertools
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from internal_monologue import Reasoner, printc
+from context_management import count_tokens
+
+
+class Node:
+    """
+    A state of the search: a fork of its parent's reasoner after one more step. Forks share their parent's messages,
+    so a node only holds the messages its step added.
+    """
+    __slots__ = ('reasoner', 'parent', 'depth', 'score', 'visits', 'value', 'children', 'terminal')
+
+    def __init__(self, reasoner, parent=None):
+        self.reasoner = reasoner
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.score = None
+        self.visits = 0
+        self.value = 0.0
+        self.children = []
+        self.terminal = False
+
+    def path(self):
+        nodes = []
+        node = self
+        while node is not None:
+            nodes.append(node)
+            node = node.parent
+        return nodes[::-1]
+
+
+class _Meter:
+    # Counts the completions and prompt tokens of the search
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = 0
+        self.tokens = 0
+        self._lock = threading.Lock()
+
+    def fork(self, reasoner):
+        # A fork of the reasoner whose completions are counted
+        fork = reasoner.fork()
+        fork.backend = _Metered(self, fork)
+        return fork
+
+    def count(self, tokens):
+        with self._lock:
+            self.calls += 1
+            self.tokens += tokens
+
+
+class _Metered:
+    # The backend of a fork in the search. The prompt tokens are the running total of the fork's context, so the
+    # messages aren't tokenized again for every completion. Equal for the whole search, so completion cache keys are too.
+    def __init__(self, meter, reasoner):
+        self.meter = meter
+        self.reasoner = reasoner
+
+    def __eq__(self, other):
+        return isinstance(other, _Metered) and other.meter is self.meter
+
+    def __hash__(self):
+        return hash(self.meter)
+
+    @property
+    def accepts_priority(self):
+        return getattr(self.meter.backend, 'accepts_priority', False)
+
+    def complete(self, messages, model='gpt-4', **kwargs):
+        context = self.reasoner.context
+        # Forks made inside expand or score share this backend, their messages are counted one by one
+        self.meter.count(context.tokens if len(messages) == len(context.messages) else sum(map(count_tokens, messages)))
+        return self.meter.backend.complete(messages=messages, model=model, **kwargs)
+
+
+def monologue_step(thought, temperature=0.8):
+    """An expand function that continues the internal monologue from `thought`, sampling a different continuation for each child."""
+    def expand(reasoner, index):
+        reasoner._start_internal_monologue(thought)
+        reasoner._finish_internal_monologue(reasoner._complete(temperature=temperature))
+    return expand
+
+
+def info_scorer(info_format="I'd rate my reasoning so far {score} out of 10.", output_type=float):
+    """A score function for structured2.StructuredReasoner nodes, which has the model rate the node with extract_info()."""
+    def score(reasoner):
+        return float(reasoner.extract_info(info_format, output_type))
+    return score
+
+
+class TreeSearch:
+    """
+    Searches over continuations of a reasoner, and commits the best path back into it.
+
+    `expand(reasoner, index)` takes one step on a fork of a node, e.g. monologue_step(). It's called with index 0 to
+    branching-1 for the children of a node, so it can vary the step. `score(reasoner)` rates a node, higher is better,
+    e.g. info_scorer() or a local heuristic. It gets its own fork, so whatever it adds to the messages is discarded.
+    `is_terminal(reasoner)` optionally marks nodes that shouldn't be expanded further.
+
+    Strategies:
+    - 'beam': expands every node of the beam, keeps the `beam_width` best children, down to `max_depth`
+    - 'best_first': expands the best node of the frontier, `iterations` times
+    - 'mcts': picks nodes to expand with UCT (`exploration` weighs unvisited paths against scores), `iterations` times,
+      and commits the most visited path
+    Up to `max_concurrency` nodes are expanded and scored at once, on a thread pool. The search stops starting new
+    expansions once `max_calls` completions or `max_tokens` prompt tokens were used (expansions and scoring both count).
+
+    An expansion or scoring that raises drops that child, and the exception is kept in `errors`. If every expansion of
+    a round fails, the search stops and raises the last exception, so a broken expand or score function isn't silent.
+    """
+    def __init__(self, expand, score, strategy='beam', branching=3, beam_width=2, max_depth=3, iterations=10,
+                 max_concurrency=4, max_calls=None, max_tokens=None, is_terminal=None, exploration=1.4):
+        assert strategy in ('beam', 'best_first', 'mcts'), "strategy must be 'beam', 'best_first' or 'mcts'"
+        self.expand = expand
+        self.score = score
+        self.strategy = strategy
+        self.branching = branching
+        self.beam_width = beam_width
+        self.max_depth = max_depth
+        self.iterations = iterations
+        self.max_concurrency = max_concurrency
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        self.is_terminal = is_terminal
+        self.exploration = exploration
+        self.root = None
+        self.meter = None
+        self.errors = []
+
+    def exhausted(self):
+        return (self.max_calls is not None and self.meter.calls >= self.max_calls
+                or self.max_tokens is not None and self.meter.tokens >= self.max_tokens)
+
+    def _grow(self, parent, index):
+        # Expands a child of parent and scores it, in a worker thread
+        if self.exhausted():
+            return None
+        child = Node(self.meter.fork(parent.reasoner), parent)
+        self.expand(child.reasoner, index)
+        child.score = float(self.score(self.meter.fork(child.reasoner)))
+        child.terminal = child.depth >= self.max_depth or bool(self.is_terminal and self.is_terminal(child.reasoner))
+        child.visits, child.value = 1, child.score
+        return child
+
+    def _expand_all(self, executor, parents):
+        futures = [(parent, executor.submit(self._grow, parent, i)) for parent in parents for i in range(self.branching)]
+        children, errors = [], []
+        for parent, future in futures:
+            try:
+                child = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            if child is not None:
+                parent.children.append(child)
+                children.append(child)
+        if errors:
+            self.errors.extend(errors)
+            if not children:
+                raise errors[-1]
+        return children
+
+    def run(self, reasoner: Reasoner):
+        """Searches from the reasoner's current state, commits the best path to it and returns its last node."""
+        self.errors = []
+        self.meter = _Meter(reasoner.backend)
+        self.root = Node(self.meter.fork(reasoner))
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        try:
+            best = getattr(self, '_' + self.strategy)(executor)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        if best is not self.root:
+            reasoner._commit(best.reasoner)
+        return best
+
+    def _beam(self, executor):
+        beam = [self.root]
+        while not self.exhausted():
+            parents = [node for node in beam if not node.terminal]
+            if not parents:
+                break
+            children = self._expand_all(executor, parents)
+            if not children:
+                break
+            beam = sorted(children + [node for node in beam if node.terminal], key=lambda node: node.score, reverse=True)[:self.beam_width]
+        return max(beam, key=lambda node: node.score if node.score is not None else -math.inf)
+
+    def _best_first(self, executor):
+        counter = itertools.count()
+        frontier = [(0, next(counter), self.root)]
+        best = self.root
+        per_round = max(1, self.max_concurrency // self.branching)
+        expansions = 0
+        while frontier and expansions < self.iterations and not self.exhausted():
+            parents = []
+            while frontier and len(parents) < min(per_round, self.iterations - expansions):
+                parents.append(heapq.heappop(frontier)[2])
+            expansions += len(parents)
+            for child in self._expand_all(executor, parents):
+                if best is self.root or child.score > best.score:
+                    best = child
+                if not child.terminal:
+                    heapq.heappush(frontier, (-child.score, next(counter), child))
+        return best
+
+    def _uct(self, parent, child):
+        if child.visits == 0:
+            return math.inf
+        return child.value / child.visits + self.exploration * math.sqrt(math.log(parent.visits) / child.visits)
+
+    def _mcts(self, executor):
+        root = self.root
+        root.visits = 1
+        per_round = max(1, self.max_concurrency // self.branching)
+        simulations = 0
+        while simulations < self.iterations and not self.exhausted():
+            # Every selected path gets a visit right away, so the other selections of the round spread out
+            leaves = []
+            for _ in range(min(per_round, self.iterations - simulations)):
+                node = root
+                node.visits += 1
+                while node.children:
+                    node = max(node.children, key=lambda child, parent=node: self._uct(parent, child))
+                    node.visits += 1
+                leaves.append(node)
+            simulations += len(leaves)
+            self._expand_all(executor, [leaf for leaf in dict.fromkeys(leaves) if not leaf.terminal])
+
+            backed_up = set()
+            for leaf in leaves:
+                if leaf.terminal:
+                    visits, value = 0, leaf.score
+                elif leaf.children and leaf not in backed_up:
+                    backed_up.add(leaf)
+                    visits, value = len(leaf.children) - 1, sum(child.score for child in leaf.children)
+                else:
+                    # Selected twice in the round, or nothing could be added: undo the visit
+                    visits, value = -1, 0.0
+                    if not leaf.children:
+                        leaf.terminal = leaf is not root
+                node = leaf
+                while node is not None:
+                    node.visits += visits
+                    node.value += value
+                    node = node.parent
+            if not root.children:
+                break
+
+        node = root
+        while node.children:
+            node = max(node.children, key=lambda child: (child.visits, child.value))
+        return node
+
+
+if __name__ == '__main__':
+    import chatgpt
+    try:
+        from cassette import from_env
+    except ImportError: # completions/ isn't on the PYTHONPATH, so there's nothing to record or replay with
+        from_env = lambda backend: backend
+    from structured2 import StructuredReasoner
+    system_prompt = (
+        "You use your internal monologue to reason before responding to the user. "
+        "You plan carefully and check your plans for mistakes."
+    )
+    reasoner = StructuredReasoner(system_prompt=system_prompt, model='gpt-4', backend=from_env(chatgpt))
+    search = TreeSearch(
+        expand=monologue_step("I'll take the next step towards a plan, or fix a mistake in the previous one."),
+        score=info_scorer("I'd rate how likely this plan is to work {score} out of 10."),
+        strategy='beam', branching=3, beam_width=2, max_depth=3, max_calls=40,
+    )
+
+    while True:
+        message = input("\nUser: ")
+        if message == "quit":
+            break
+        reasoner.add_message('user', message)
+
+        best = search.run(reasoner)
+        for node in best.path()[1:]:
+            printc(f"\n[score {node.score:g}] " + node.reasoner.messages[-1]['content'], color='blue')
+        printc(f"\n{search.meter.calls} completions, {search.meter.tokens} prompt tokens", color='yellow')
+
+        response = reasoner.external_dialogue("I'll respond to the user with the plan I came up with.")
+        print('\n' + response)
@@ -0,0 +1,197 @@
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+_ids = itertools.count(1)
+
+
+class Span:
+    """
+    A timed step, used as a context manager. Spans opened inside it (in the same thread or task) become its children.
+    Attributes can be added with set() until the span ends, then it's sent to the tracer's sinks.
+    Generators are traced with iterate() / aiterate() instead, see below.
+    """
+    __slots__ = ('tracer', 'name', 'attrs', 'id', 'parent', 'start', 'duration', '_start', '_token')
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.id = next(_ids)
+        self.parent = None
+        self.start = None
+        self.duration = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def _begin(self):
+        parent = _current_span.get()
+        self.parent = parent.id if parent is not None else None
+        self.start = time.time_ns()
+        self._start = time.perf_counter_ns()
+
+    def _end(self, error=None):
+        self.duration = time.perf_counter_ns() - self._start
+        if error is not None and not isinstance(error, GeneratorExit):
+            self.attrs['error'] = f'{type(error).__name__}: {error}'
+        self.tracer.emit(self)
+
+    def __enter__(self):
+        self._begin()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            _current_span.reset(self._token)
+        except ValueError: # exited in a different context than it was entered in, e.g. by another task
+            pass
+        self._end(exc_value if exc_type is not None else None)
+
+    # A span entered in a generator would stay current while the generator is suspended, so the consumer's spans would
+    # become its children. iterate() and aiterate() time the whole generator, but only make the span (or whichever
+    # span the generator opened inside it) current while the generator runs, one step at a time.
+
+    def iterate(self, generator):
+        """Runs the generator in the span, which ends when the generator does. Sent values, throw() and close() are passed on."""
+        self._begin()
+        current, step, value = self, generator.send, None
+        try:
+            while True:
+                token = _current_span.set(current)
+                try:
+                    item = step(value)
+                finally:
+                    current = _current_span.get()
+                    _current_span.reset(token)
+                try:
+                    step, value = generator.send, (yield item)
+                except GeneratorExit:
+                    token = _current_span.set(current)
+                    try:
+                        generator.close()
+                    finally:
+                        _current_span.reset(token)
+                    raise
+                except BaseException as e:
+                    step, value = generator.throw, e
+        except StopIteration as e:
+            self._end()
+            return e.value
+        except BaseException as e:
+            self._end(e)
+            raise
+
+    async def aiterate(self, generator):
+        """Async version of iterate(), for async generators."""
+        self._begin()
+        current, step, value = self, generator.asend, None
+        try:
+            while True:
+                token = _current_span.set(current)
+                try:
+                    item = await step(value)
+                finally:
+                    current = _current_span.get()
+                    _current_span.reset(token)
+                try:
+                    step, value = generator.asend, (yield item)
+                except GeneratorExit:
+                    token = _current_span.set(current)
+                    try:
+                        await generator.aclose()
+                    finally:
+                        _current_span.reset(token)
+                    raise
+                except BaseException as e:
+                    step, value = generator.athrow, e
+        except StopAsyncIteration:
+            self._end()
+        except BaseException as e:
+            self._end(e)
+            raise
+
+    def record(self):
+        return {
+            'name': self.name, 'id': self.id, 'parent': self.parent, 'start_us': self.start // 1000,
+            'duration_us': self.duration / 1000, 'pid': os.getpid(), 'thread': threading.get_ident(), **self.attrs,
+        }
+
+
+class Tracer:
+    """
+    Creates spans and sends the finished ones to its sinks. A sink is anything with an emit(record) method.
+
+    Everything that can be traced takes an optional `tracer`, and skips tracing entirely when it's None, so tracing
+    only costs something when it's turned on.
+    """
+    def __init__(self, *sinks):
+        self.sinks = list(sinks)
+
+    def span(self, name, **attrs):
+        return Span(self, name, attrs)
+
+    def emit(self, span):
+        record = span.record()
+        for sink in self.sinks:
+            sink.emit(record)
+
+    def close(self):
+        for sink in self.sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+
+
+class MemorySink:
+    """Keeps the span records in a list."""
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class JSONLSink:
+    """Appends one JSON line per span."""
+    def __init__(self, path):
+        self._file = open(path, 'a', buffering=1)
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        self._file.close()
+
+
+class ChromeTraceSink:
+    """
+    Writes spans in the Chrome trace event format, which can be opened in chrome://tracing or https://ui.perfetto.dev.
+    The closing bracket of the event array is optional in this format, so the file can be read while it's still being written.
+    """
+    def __init__(self, path):
+        self._file = open(path, 'w', buffering=1)
+        self._file.write('[\n')
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        args = {k: v for k, v in record.items() if k not in ('name', 'start_us', 'duration_us', 'pid', 'thread')}
+        event = {
+            'name': record['name'], 'ph': 'X', 'ts': record['start_us'], 'dur': record['duration_us'],
+            'pid': record['pid'], 'tid': record['thread'], 'args': args,
+        }
+        line = json.dumps(event, default=str) + ',\n'
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        self._file.write('{}]\n')
+        self._file.close()